@@ -5,6 +5,7 @@ import vtk
 import utils
 import io_utils
 import marching_cube as m_c
+from label_volume import LabelVolume
 
 #TO-DO improve compatibility with label ids, line 32
 class Images(object):
@@ -33,22 +34,17 @@ class LVImage(Images):
     
     def erase_boundary(self):
         ### this is only needed for a more general left heart model
-        from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
-        x, y, z = self.label.GetDimensions()
-        pylabel = vtk_to_numpy(self.label.GetPointData().GetScalars()).reshape(z, y, x).transpose(2, 1, 0)
-        pylabel = utils.erase_boundary(pylabel, 2, 0)
-        self.label.GetPointData().SetScalars(numpy_to_vtk(pylabel.transpose(2, 1, 0).flatten()))
+        vol = LabelVolume(self.label)
+        utils.erase_boundary(vol.array, 2, 0)
+        vol.modified()
 
     def process(self, remove_list):
         self.label = utils.vtk_image_resample(self.label, spacing=(1.2, 1.2, 1.2), opt='NN')
-        from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
-        pylabel = vtk_to_numpy(self.label.GetPointData().GetScalars())
-        pylabel = utils.swap_labels(pylabel)
+        vol = LabelVolume(self.label)
+        pylabel = utils.swap_labels(vol.flat)
 
         #remove myocardium, RV, RA and PA
-        for tissue in remove_list:
-            pylabel = utils.remove_class(pylabel, tissue, 0)
-        self.label.GetPointData().SetScalars(numpy_to_vtk(pylabel))
+        vol.set_scalars(utils.remove_class(pylabel, remove_list, 0))
         # remove small islands
         self.label = utils.extract_largest_connected_region(self.label, 6)
         self.label = utils.extract_largest_connected_region(self.label, 3)
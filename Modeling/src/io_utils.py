@@ -7,6 +7,8 @@ IO functions for importing and exporting label maps and mesh surfaces
 import numpy as np
 import os
 import vtk
+from reorient import execute_reslice
+import parallel_gzip
 
 def read_label_map(fn):
     """ 
@@ -27,8 +29,10 @@ def read_label_map(fn):
         label = reader.GetOutput()
     elif ext[-3:]=='nii' or ext[-6:]=='nii.gz':
         reader = vtk.vtkNIFTIImageReader()
-        reader.SetFileName(fn)
-        reader.Update()
+        #block gzipped files are inflated in parallel, others read by VTK
+        with parallel_gzip.decompressed(fn) as nii_fn:
+            reader.SetFileName(nii_fn)
+            reader.Update()
 
         image = reader.GetOutput()
         matrix = reader.GetQFormMatrix()
@@ -39,9 +43,9 @@ def read_label_map(fn):
         reslice.SetInputData(image)
         reslice.SetResliceAxes(matrix)
         reslice.SetInterpolationModeToNearestNeighbor()
-        reslice.Update()
+        #numpy transpose/flip if the orientation is a permutation with flips
         reslice2 = vtk.vtkImageReslice()
-        reslice2.SetInputData(reslice.GetOutput())
+        reslice2.SetInputData(execute_reslice(reslice))
         matrix = vtk.vtkMatrix4x4()
         for i in range(4):
             matrix.SetElement(i,i,1)
@@ -49,8 +53,7 @@ def read_label_map(fn):
         matrix.SetElement(1,1,-1)
         reslice2.SetResliceAxes(matrix)
         reslice2.SetInterpolationModeToNearestNeighbor()
-        reslice2.Update()
-        label = reslice2.GetOutput()
+        label = execute_reslice(reslice2)
     else:
         raise IOError("File extension is not recognized")
     
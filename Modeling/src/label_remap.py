@@ -0,0 +1,78 @@
+"""
+Lookup-table remapping of label ids, shared by the segmentation and modeling code
+
+@author Fanwei Kong
+"""
+import numpy as np
+
+def present_labels(labels):
+    """
+    Sorted label ids present in a label map (np.unique with a single
+    bincount pass for integer label maps)
+    """
+    if labels.size == 0:
+        return np.array([], dtype=labels.dtype)
+    if not np.issubdtype(labels.dtype, np.integer):
+        return np.unique(labels)
+    lo = int(np.min(labels))
+    counts = np.bincount(_offset_indices(labels.ravel(), lo))
+    return (np.nonzero(counts)[0] + lo).astype(labels.dtype)
+
+def _offset_indices(flat, lo):
+    if lo == 0:
+        return flat.astype(np.intp, copy=False)
+    return flat.astype(np.intp) - lo
+
+def _compact_dtype(values):
+    values = np.asarray(values)
+    if values.size == 0 or np.all(np.mod(values, 1) == 0):
+        if values.size == 0 or (values.min() >= 0 and values.max() <= np.iinfo(np.uint8).max):
+            return np.uint8
+        if values.min() >= np.iinfo(np.int16).min and values.max() <= np.iinfo(np.int16).max:
+            return np.int16
+        return np.int64
+    return np.result_type(values.dtype, np.float32)
+
+def remap_labels(labels, src, dst, default=None, dtype=None, chunk=1 << 20):
+    """
+    Maps the label ids in src to the ids in dst with a lookup table applied in
+    one np.take pass. Ids not in src are set to default, or kept if default is
+    None.
+
+    Args:
+        labels: integer label map (numpy array of any shape)
+        src: label ids to replace
+        dst: new label ids, same length as src
+        default: id of the labels not in src, None to keep them
+        dtype: output dtype, by default the most compact type holding all
+            output ids (uint8 for label maps)
+        chunk: number of voxels mapped at once, bounds the temporary index array
+    Returns:
+        out: remapped label map
+    """
+    labels = np.asarray(labels)
+    src = np.asarray(src).astype(np.int64).ravel()
+    dst = np.asarray(dst).ravel()
+    if len(src) != len(dst):
+        raise ValueError("Source and destination label ids should have the same length")
+    if labels.size == 0:
+        return labels.astype(dtype or _compact_dtype(dst))
+    lo, hi = int(np.min(labels)), int(np.max(labels))
+    if not np.issubdtype(labels.dtype, np.integer) and np.any(np.mod(labels, 1) != 0):
+        raise ValueError("Label map should contain integer ids")
+    if default is None:
+        lut = np.arange(lo, hi+1)
+    else:
+        lut = np.full(hi-lo+1, default, dtype=np.result_type(dst.dtype, type(default)))
+    if dtype is None:
+        dtype = _compact_dtype(np.concatenate([lut, dst]) if default is None else np.append(dst, default))
+    lut = lut.astype(dtype)
+    inside = (src >= lo) & (src <= hi)
+    lut[src[inside] - lo] = dst[inside]
+
+    out = np.empty(labels.shape, dtype=dtype)
+    flat_in = labels.reshape(-1)
+    flat_out = out.reshape(-1)
+    for i in range(0, flat_in.size, chunk):
+        np.take(lut, _offset_indices(flat_in[i:i+chunk], lo), out=flat_out[i:i+chunk])
+    return out
@@ -0,0 +1,128 @@
+"""
+Label map volume whose voxels live in one buffer shared by a vtkImageData and
+a numpy view
+
+@author Fanwei Kong
+"""
+import numpy as np
+import vtk
+from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk, get_vtk_array_type
+
+class LabelVolume(object):
+    """
+    Wraps a single component vtkImageData. The numpy views returned by
+    buffer, flat and array share memory with the VTK scalars, so edits made
+    through them are seen by VTK filters without any copy. Call modified()
+    after editing so that downstream filters re-execute.
+    """
+    def __init__(self, image):
+        self.image = image
+
+    @classmethod
+    def from_array(cls, py_label, spacing=(1., 1., 1.), origin=(0., 0., 0.)):
+        """
+        Creates a label volume from a numpy array indexed (x, y, z)
+        """
+        py_label = np.asarray(py_label)
+        image = vtk.vtkImageData()
+        image.SetDimensions(*py_label.shape)
+        image.SetSpacing(spacing)
+        image.SetOrigin(origin)
+        vol = cls(image)
+        vol.set_scalars(py_label.transpose(2, 1, 0))
+        return vol
+
+    @classmethod
+    def zeros_like(cls, image, dtype=None):
+        """
+        Creates a zero label volume with the geometry of a vtkImageData, the
+        scalars of image are not copied
+        """
+        if dtype is None:
+            dtype = LabelVolume(image).dtype
+        out = vtk.vtkImageData()
+        out.SetExtent(image.GetExtent())
+        out.SetSpacing(image.GetSpacing())
+        out.SetOrigin(image.GetOrigin())
+        vol = cls(out)
+        x, y, z = image.GetDimensions()
+        vol.set_scalars(np.zeros((z, y, x), dtype=dtype))
+        return vol
+
+    @property
+    def scalars(self):
+        return self.image.GetPointData().GetScalars()
+
+    @property
+    def shape(self):
+        return tuple(self.image.GetDimensions())
+
+    @property
+    def spacing(self):
+        return np.array(self.image.GetSpacing())
+
+    @property
+    def origin(self):
+        return np.array(self.image.GetOrigin())
+
+    @property
+    def dtype(self):
+        return self.flat.dtype
+
+    @property
+    def flat(self):
+        """
+        1D view of the voxels in VTK order (x fastest)
+        """
+        return vtk_to_numpy(self.scalars)
+
+    @property
+    def buffer(self):
+        """
+        C-contiguous view of the voxels indexed (z, y, x)
+        """
+        x, y, z = self.shape
+        return self.flat.reshape(z, y, x)
+
+    @property
+    def array(self):
+        """
+        View of the voxels indexed (x, y, z)
+        """
+        return self.buffer.transpose(2, 1, 0)
+
+    def set_scalars(self, buf):
+        """
+        Makes buf the voxel buffer of the image. buf is in VTK order and is
+        only copied if it is not C-contiguous.
+        """
+        buf = np.ascontiguousarray(buf)
+        if buf.size != np.prod(self.shape):
+            raise ValueError("Buffer of %d voxels does not match the image dimensions %s" % (buf.size, self.shape))
+        old = self.scalars
+        # numpy_to_vtk keeps a reference to buf, no copy is made
+        scalars = numpy_to_vtk(buf.reshape(-1), array_type=get_vtk_array_type(buf.dtype))
+        if old is not None:
+            scalars.SetName(old.GetName())
+        self.image.GetPointData().SetScalars(scalars)
+        return self
+
+    def modified(self):
+        """
+        Marks the image as modified after its voxels were edited in place
+        """
+        self.scalars.Modified()
+        self.image.Modified()
+        return self
+
+    def physical_points(self, ids):
+        """
+        Physical coordinates of (x, y, z) voxel indices
+        """
+        return np.asarray(ids).reshape(-1, 3) * self.spacing + self.origin
+
+def as_label_volume(im):
+    """
+    Wraps a vtkImageData into a LabelVolume, LabelVolume inputs are returned as is
+    """
+    return im if isinstance(im, LabelVolume) else LabelVolume(im)
@@ -0,0 +1,163 @@
+"""
+Multi-threaded block gzip compression and decompression of NIfTI volumes
+
+Files are written as a sequence of standard gzip members, one per block, so
+any gzip reader (zlib, VTK, nibabel, gunzip) can read them. Every member
+records its compressed size in an FEXTRA subfield, as BGZF does, which lets
+the blocks be located and inflated in parallel. BGZF files (bgzip) are
+decompressed in parallel as well; other gzip files are left to the regular
+single-threaded readers.
+
+@author Fanwei Kong
+"""
+import os
+import struct
+import tempfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+BLOCK_SIZE = 1 << 22
+# subfield id and length of the member size index
+SUBFIELD = b'PZ'
+_HEADER = struct.Struct('<4BIBBH2sHI')
+_HEADER_SIZE = _HEADER.size
+_FEXTRA = 4
+
+def _threads(threads):
+    return threads or os.cpu_count() or 1
+
+def _compress_block(block, level):
+    comp = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    payload = comp.compress(block) + comp.flush()
+    size = _HEADER_SIZE + len(payload) + 8
+    header = _HEADER.pack(0x1f, 0x8b, 8, _FEXTRA, 0, 0, 255, 8, SUBFIELD, 4, size)
+    return header + payload + struct.pack('<II', zlib.crc32(block) & 0xffffffff, len(block) & 0xffffffff)
+
+def compress(data, out_fn, level=6, threads=None, block_size=BLOCK_SIZE):
+    """
+    Writes data as a block gzip file, compressing the blocks in worker threads
+
+    Args:
+        data: bytes-like object
+        out_fn: output filename (.gz)
+        level: compression level 0-9
+        threads: number of threads, the CPU count by default
+        block_size: uncompressed bytes per gzip member
+    """
+    data = memoryview(data).cast('B')
+    blocks = [data[i:i+block_size] for i in range(0, max(len(data), 1), block_size)]
+    with ThreadPoolExecutor(_threads(threads)) as pool, open(out_fn, 'wb') as f:
+        for member in pool.map(lambda b: _compress_block(b, level), blocks):
+            f.write(member)
+    return
+
+def compress_file(in_fn, out_fn, level=6, threads=None):
+    with open(in_fn, 'rb') as f:
+        data = f.read()
+    compress(data, out_fn, level, threads)
+
+def _member_size(data, pos):
+    """
+    Size of the gzip member starting at pos from its FEXTRA subfield, and the
+    offset of its compressed payload; None if the member has no size index
+    """
+    if len(data) - pos < 12 or data[pos] != 0x1f or data[pos+1] != 0x8b or not data[pos+3] & _FEXTRA:
+        return None
+    xlen = struct.unpack_from('<H', data, pos+10)[0]
+    if len(data) - pos < 12 + xlen:
+        return None
+    size = None
+    sub = pos + 12
+    while sub + 4 <= pos + 12 + xlen:
+        sid, slen = bytes(data[sub:sub+2]), struct.unpack_from('<H', data, sub+2)[0]
+        if sid == SUBFIELD and slen == 4:
+            size = struct.unpack_from('<I', data, sub+4)[0]
+        elif sid == b'BC' and slen == 2:
+            size = struct.unpack_from('<H', data, sub+4)[0] + 1
+        sub += 4 + slen
+    # other header fields (name, comment) are not written by block gzip tools
+    if size is None or data[pos+3] & ~_FEXTRA:
+        return None
+    return size, pos + 12 + xlen
+
+def _member_index(data):
+    """
+    Offsets and sizes of the members of a block gzip file, or None if the file
+    has no member size index
+    """
+    members = []
+    pos = 0
+    while pos < len(data):
+        member = _member_size(data, pos)
+        if member is None:
+            return None
+        size, payload = member
+        members.append((pos, payload, size))
+        pos += size
+    return members if pos == len(data) else None
+
+def _inflate_member(data, start, payload, size):
+    block = zlib.decompress(data[payload:start+size-8], -zlib.MAX_WBITS)
+    crc, isize = struct.unpack_from('<II', data, start+size-8)
+    if zlib.crc32(block) & 0xffffffff != crc or len(block) & 0xffffffff != isize:
+        raise IOError("CRC check failed in gzip member at offset %d" % start)
+    return block
+
+def decompress(fn, threads=None):
+    """
+    Decompresses a block gzip file, inflating the members in worker threads
+
+    Returns:
+        data: decompressed bytes, None if the file is not block gzipped
+    """
+    with open(fn, 'rb') as f:
+        # plain single member gzip files are rejected from their first header
+        # without being read, the default reader then reads them once
+        header = f.read(12)
+        if len(header) < 12 or header[0] != 0x1f or header[1] != 0x8b or not header[3] & _FEXTRA:
+            return None
+        header += f.read(struct.unpack_from('<H', header, 10)[0])
+        if _member_size(header, 0) is None:
+            return None
+        f.seek(0)
+        data = f.read()
+    members = _member_index(memoryview(data))
+    if members is None:
+        return None
+    with ThreadPoolExecutor(_threads(threads)) as pool:
+        blocks = list(pool.map(lambda m: _inflate_member(data, *m), members))
+    return b''.join(blocks)
+
+@contextmanager
+def decompressed(fn, threads=None):
+    """
+    Context manager giving a filename readable by the single-threaded readers:
+    an uncompressed temporary copy of a block gzipped fn, or fn itself
+    otherwise (and whenever the parallel path fails)
+    """
+    tmp_fn = None
+    if fn.endswith('.gz'):
+        try:
+            data = decompress(fn, threads)
+            if data is not None:
+                # next to the input, or in the default temporary directory if
+                # that is read-only; a small tmpfs such as /dev/shm would fill up
+                suffix = os.path.basename(fn)[:-3]
+                try:
+                    fd, tmp_fn = tempfile.mkstemp(suffix=suffix, dir=os.path.dirname(os.path.abspath(fn)))
+                except OSError:
+                    fd, tmp_fn = tempfile.mkstemp(suffix=suffix)
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                del data
+        except (IOError, OSError, zlib.error, struct.error) as e:
+            print("Parallel gzip decompression failed, using the default reader: ", e)
+            if tmp_fn is not None and os.path.exists(tmp_fn):
+                os.remove(tmp_fn)
+            tmp_fn = None
+    try:
+        yield tmp_fn if tmp_fn is not None else fn
+    finally:
+        if tmp_fn is not None:
+            os.remove(tmp_fn)
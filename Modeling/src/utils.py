@@ -5,6 +5,8 @@ Utility functions for label map editing
 """
 import numpy as np
 import vtk
+from label_remap import remap_labels, present_labels
+from label_volume import LabelVolume, as_label_volume
 
 def natural_sort(l):
     import re
@@ -19,10 +21,8 @@ def swap_labels(pyImage):
     """
     Swap label ids
     """
-    ids = np.unique(pyImage)
-    for i, v in enumerate(ids):
-        pyImage[pyImage==v] = i
-    return pyImage
+    ids = present_labels(pyImage)
+    return remap_labels(pyImage, ids, np.arange(len(ids)), default=0)
 
 def fit_plane_normal(points_input):
     """
@@ -101,13 +101,8 @@ def normalize_label_map(labels, values=[], keep=[]):
     #labels = sitk.Cast(labels,  sitk.sitkFloat32)
     py_label = sitk.GetArrayFromImage(labels)
 
-    ids = np.unique(py_label)
     #values = np.linspace(rng[0], rng[1], len(keep), endpoint=True) #if keep is empty, convert to binary
-    for index, i in enumerate(ids):
-        if i in keep:
-            py_label[py_label==i] = values[keep.index(i)]
-        else:
-            py_label[py_label==i] = 0.
+    py_label = remap_labels(py_label, keep, values[:len(keep)], default=0)
     labels_new = sitk.GetImageFromArray(py_label)
     labels_new.SetOrigin(labels.GetOrigin())
     labels_new.SetDirection(labels.GetDirection())
@@ -139,14 +134,14 @@ def remove_class(labels, class_id, bg_id):
     Convert class label to background label
 
     Args:
-        class_id: the id number of the class to remove
+        class_id: the id number (or list of id numbers) of the class to remove
         labels: label map
         bg_id: id number of background
     Returns:
         labels: edited label map
     """
-    labels[np.where(labels==class_id)] = bg_id
-    return labels
+    class_id = np.atleast_1d(class_id)
+    return remap_labels(labels, class_id, np.full(len(class_id), bg_id))
 
 ################################
 ## VTK PolyData functions
@@ -339,17 +334,9 @@ def get_centroid(im, label_id):
     Returns:
         centroid: np array of the centroid coordinates
     """
-    from vtk.util.numpy_support import vtk_to_numpy
-
-    x, y, z = im.GetDimensions()
-    pyIm = vtk_to_numpy(im.GetPointData().GetScalars()).reshape(z, y, x).transpose(2, 1, 0)
-    ids = np.array(np.where(pyIm==label_id)).transpose()
-    total_num = len(ids)
-    
-    origin = np.tile(im.GetOrigin(), total_num).reshape(total_num,3)
-    spacing = np.tile(im.GetSpacing(), total_num).reshape(total_num,3)
-    
-    centroid = np.mean(spacing * ids + origin, axis=0)
+    vol = as_label_volume(im)
+    ids = np.array(np.nonzero(vol.array==label_id)).transpose()
+    centroid = np.mean(ids, axis=0) * vol.spacing + vol.origin
     return centroid
 
 def locate_region_boundary_ids(im, label_id1, label_id2, size = 1., bg_id = None):
@@ -364,8 +351,8 @@ def locate_region_boundary_ids(im, label_id1, label_id2, size = 1., bg_id = None
     Returns
         ids: ids of the boundary points
     """
-    new_Im = vtk.vtkImageData()
-    new_Im.DeepCopy(im)
+    vol = as_label_volume(im)
+    new_Im = vol.image
     if bg_id is not None:
         dilateErode = vtk.vtkImageDilateErode3D()
         dilateErode.SetInputData(new_Im)
@@ -386,12 +373,7 @@ def locate_region_boundary_ids(im, label_id1, label_id2, size = 1., bg_id = None
     dilateErode.Update()
     newIm = dilateErode.GetOutput()
 
-    from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
-
-    x, y, z = newIm.GetDimensions()
-    pyIm_new = vtk_to_numpy(newIm.GetPointData().GetScalars()).reshape(z, y, x).transpose(2, 1, 0)
-    pyIm = vtk_to_numpy(im.GetPointData().GetScalars()).reshape(z, y, x).transpose(2, 1, 0)
-    ids = np.array(np.where(pyIm_new-pyIm!=0)).transpose()
+    ids = np.array(np.nonzero(LabelVolume(newIm).array != vol.array)).transpose()
     return ids
 
 
@@ -408,12 +390,7 @@ def locateRegionBoundary(im, label_id1, label_id2, size=1.):
         points: coordinates of the boundary points
     """
     ids = locate_region_boundary_ids(im, label_id1, label_id2, size)
-    
-    total_num = len(ids)
-    
-    origin = np.tile(im.GetOrigin(), total_num).reshape(total_num,3)
-    spacing = np.tile(im.GetSpacing(), total_num).reshape(total_num,3)
-    points = ids * spacing + origin
+    points = as_label_volume(im).physical_points(ids)
     return points
 
 
@@ -430,27 +407,18 @@ def recolor_vtk_pixels_by_plane(labels, ori, nrm, bg_id, label_id=None):
     Returns:
         labels: editted VTK image
     """
-
-    from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
-    pyLabel = vtk_to_numpy(labels.GetPointData().GetScalars())
-    spacing = labels.GetSpacing()
-    origin = labels.GetOrigin()
-    X, Y, Z = labels.GetDimensions()
-    total_num = X*Y*Z
-    
-    x, y, z = np.meshgrid(range(Y), range(Z), range(X))
-    indices = np.moveaxis(np.vstack((z.flatten(),x.flatten(),y.flatten())),0,1)
-    b = np.tile(spacing, total_num).reshape(total_num,3)
-    physical = indices * b +np.tile(origin, total_num).reshape(total_num,3)
-    vec1 = physical - np.tile(ori, total_num).reshape(total_num,3)
-    vec2 = np.tile(nrm, total_num).reshape(total_num,3)
-    above = np.sum(vec1*vec2, axis=1)>0
-    if label_id is not None:
-        above = np.logical_and(above, pyLabel!=label_id)
-    pyLabel[above] = bg_id
-    labels.GetPointData().SetScalars(numpy_to_vtk(pyLabel))
-
-    return labels
+    vol = as_label_volume(labels)
+    # signed distance to the plane is separable: one term per axis
+    dist = [(np.arange(n)*s + o - p)*v for n, s, o, p, v in zip(vol.shape, vol.spacing, vol.origin, ori, nrm)]
+    plane = dist[1][:, np.newaxis] + dist[0][np.newaxis, :]
+    buf = vol.buffer
+    for k in range(buf.shape[0]):
+        above = plane + dist[2][k] > 0
+        if label_id is not None:
+            above &= buf[k] != label_id
+        buf[k][above] = bg_id
+    vol.modified()
+    return vol.image
 
 def recolor_vtk_pixels_by_ids(labels, ids, bg_id):
     """
@@ -462,15 +430,11 @@ def recolor_vtk_pixels_by_ids(labels, ids, bg_id):
         bg_id: class id to change to
     Returns: editted VTK image
     """
-    from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
-    x, y, z = labels.GetDimensions()
-    pyLabel = vtk_to_numpy(labels.GetPointData().GetScalars()).reshape(z, y, x).transpose(2, 1, 0)
-  
-    for i in ids:
-        pyLabel[i[0], i[1], i[2]] = bg_id
-    labels.GetPointData().SetScalars(numpy_to_vtk(pyLabel.transpose(2,1,0).flatten()))
-
-    return labels
+    vol = as_label_volume(labels)
+    ids = np.asarray(ids, dtype=int).reshape(-1, 3)
+    vol.array[ids[:, 0], ids[:, 1], ids[:, 2]] = bg_id
+    vol.modified()
+    return vol.image
 
 
 def recolor_vtk_image_by_polydata(poly, vtk_image, new_id):
@@ -484,13 +448,11 @@ def recolor_vtk_image_by_polydata(poly, vtk_image, new_id):
     Return:
         new_image: modified vtk image
     """
-    from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
-    poly_im = convert_polydata_to_image_data(poly, vtk_image)
-    poly_im_py = vtk_to_numpy(poly_im.GetPointData().GetScalars())
-    vtk_im_py = vtk_to_numpy(vtk_image.GetPointData().GetScalars())
-    vtk_im_py[poly_im_py>0] = new_id
-    vtk_image.GetPointData().SetScalars(numpy_to_vtk(vtk_im_py))
-    return vtk_image
+    vol = as_label_volume(vtk_image)
+    poly_im = convert_polydata_to_image_data(poly, vol.image)
+    vol.flat[LabelVolume(poly_im).flat>0] = new_id
+    vol.modified()
+    return vol.image
 
 def vtk_image_resample(image, spacing, opt):
     """
@@ -533,11 +495,11 @@ def convert_vtk_im_to_binary(labels):
     Returns:
         labels: converted VTK image
     """
-    from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
-    pyLabel = vtk_to_numpy(labels.GetPointData().GetScalars())
-    pyLabel[np.where(pyLabel!=0)] = 1
-    labels.GetPointData().SetScalars(numpy_to_vtk(pyLabel))
-    return labels
+    vol = as_label_volume(labels)
+    py_label = vol.flat
+    py_label[py_label!=0] = 1
+    vol.modified()
+    return vol.image
 
 
 def extract_largest_connected_region(vtk_im, label_id):
@@ -554,16 +516,14 @@ def extract_largest_connected_region(vtk_im, label_id):
     fltr = vtk.vtkImageConnectivityFilter()
     fltr.SetScalarRange(label_id, label_id)
     fltr.SetExtractionModeToLargestRegion()
-    fltr.SetInputData(vtk_im)
+    vol = as_label_volume(vtk_im)
+    fltr.SetInputData(vol.image)
     fltr.Update()
-    new_im = fltr.GetOutput()
-    from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
-    py_im = vtk_to_numpy(vtk_im.GetPointData().GetScalars())
-    py_mask = vtk_to_numpy(new_im.GetPointData().GetScalars())
-    mask = np.logical_and(py_im==label_id, py_mask==0)
+    py_im = vol.flat
+    mask = np.logical_and(py_im==label_id, LabelVolume(fltr.GetOutput()).flat==0)
     py_im[mask] = 0
-    vtk_im.GetPointData().SetScalars(numpy_to_vtk(py_im))
-    return vtk_im
+    vol.modified()
+    return vol.image
 
 def cut_polydata_with_another(poly1, poly2, plane_info):
     """
@@ -1277,11 +1237,7 @@ def convert_polydata_to_image_data(poly, ref_im, reverse=True):
     Returns:
         output: resulted vtkImageData
     """
-    from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
-    # Have to copy to create a zeroed vtk image data
-    ref_im_zeros = vtk.vtkImageData()
-    ref_im_zeros.DeepCopy(ref_im)
-    ref_im_zeros.GetPointData().SetScalars(numpy_to_vtk(np.zeros(vtk_to_numpy(ref_im_zeros.GetPointData().GetScalars()).shape)))
+    ref_im_zeros = LabelVolume.zeros_like(ref_im, np.uint8).image
     ply2im = vtk.vtkPolyDataToImageStencil()
     ply2im.SetTolerance(0.05)
     ply2im.SetInputData(poly)
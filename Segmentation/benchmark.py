@@ -0,0 +1,135 @@
+"""
+Throughput benchmark of the segmentation inference on synthetic data
+
+Runs model_output_no_resize and Prediction.volume_prediction_average with
+randomly initialized UNet2D weights on synthetic volumes, so no trained weights
+or images are needed. Every configuration runs in a fresh process so that the
+reported peak RSS belongs to that configuration only.
+
+@author: Fanwei Kong
+"""
+import os
+import numpy as np
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), "src"))
+import argparse
+import itertools
+import json
+import multiprocessing
+import resource
+import shutil
+import tempfile
+import time
+
+def synthetic_volume(size, seed=0):
+    """
+    Smooth random volume in [-1, 1] resembling a normalized image
+    """
+    rng = np.random.RandomState(seed)
+    coarse = rng.uniform(-1., 1., size=(8, 8, 8))
+    vol = coarse
+    for axis in range(3):
+        vol = np.repeat(vol, int(np.ceil(size/8.)), axis=axis)
+    vol = vol[:size, :size, :size] + 0.1*rng.standard_normal((size, size, size))
+    return np.clip(vol, -1., 1.).astype(np.float32)
+
+def random_weights(out_dir, img_shape, num_class, num_models, seed=0):
+    """
+    Saves num_models randomly initialized UNet2D weight files
+    """
+    import tensorflow as tf
+    from tensorflow.python.keras import models as models_keras
+    from tensorflow.python.keras import backend as K
+    from model import UNet2D
+    fns = []
+    for i in range(num_models):
+        K.clear_session()
+        tf.set_random_seed(seed+i)
+        inputs, outputs = UNet2D(img_shape, num_class)
+        unet = models_keras.Model(inputs=[inputs], outputs=[outputs])
+        fns.append(os.path.join(out_dir, 'random_%d.hdf5' % i))
+        unet.save_weights(fns[-1])
+    K.clear_session()
+    return fns
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.**2 if sys.platform == 'darwin' else 1024.)
+
+def run_config(config):
+    """
+    Benchmarks one configuration, to be run in a fresh process
+
+    Args:
+        config: dictionary with size, batch_size, channel, views and ensemble
+    Returns:
+        result: config updated with the timings of both benchmarks
+    """
+    from model_pool import ModelPool
+    from prediction import Prediction, model_output_no_resize
+    size, channel, views = config['size'], config['channel'], list(config['views'])
+    num_class = 8
+    tmp_dir = tempfile.mkdtemp()
+    result = dict(config)
+    try:
+        weights = random_weights(tmp_dir, (size, size, channel), num_class, config['ensemble'])
+        pool = ModelPool((size, size, channel), num_class)
+        vol = synthetic_volume(size)
+
+        unet = pool.get(weights[0])
+        # warm up the graph before timing
+        model_output_no_resize(unet, vol[:, :, :2], 2, channel, config['batch_size'])
+        start = time.time()
+        prob = np.zeros(vol.shape+(num_class,), dtype=np.float32)
+        model_output_no_resize(unet, vol, views[0], channel, config['batch_size'], out=prob)
+        wall = time.time() - start
+        del prob
+        result['model_output'] = {'wall_time': wall, 'slices': size, 'slices_per_s': size/wall, 'peak_rss_mb': peak_rss_mb()}
+
+        models = [weights[i] for i in range(config['ensemble']) for _ in views]
+        model_views = views * config['ensemble']
+        for fn in weights:
+            pool.get(fn)
+        predict = Prediction(pool, models, 'ct', model_views, None, None, channel, config['batch_size'], np.float32)
+        start = time.time()
+        predict.volume_prediction_average(size, vol)
+        wall = time.time() - start
+        slices = size * len(models)
+        result['volume_average'] = {'wall_time': wall, 'slices': slices, 'slices_per_s': slices/wall, 'peak_rss_mb': peak_rss_mb()}
+    finally:
+        shutil.rmtree(tmp_dir)
+    return result
+
+def benchmark_main(sizes, batch_sizes, channels, view_sets, ensembles, out_fn=None):
+    configs = [{'size': s, 'batch_size': b, 'channel': c, 'views': v, 'ensemble': e} for s, b, c, v, e in itertools.product(sizes, batch_sizes, channels, view_sets, ensembles)]
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    for config in configs:
+        print("Benchmarking ", config)
+        with ctx.Pool(1) as p:
+            try:
+                results.append(p.apply(run_config, (config,)))
+            except Exception as e:
+                print(e)
+                results.append(dict(config, error=str(e)))
+    out = json.dumps(results, indent=2)
+    if out_fn is None:
+        print(out)
+    else:
+        with open(out_fn, 'w') as f:
+            f.write(out)
+    return results
+
+if __name__ == '__main__':
+    from prediction import parse_batch_size
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, nargs='+', default=[128], help='Volume sizes')
+    parser.add_argument('--batch_size', type=parse_batch_size, nargs='+', default=[1, 8], help='Batch sizes (integer or auto)')
+    parser.add_argument('--n_channel', type=int, nargs='+', default=[1], help='Numbers of input channels')
+    parser.add_argument('--views', nargs='+', default=['0', '012'], help='View sets, e.g. 0 for axial only or 012 for all views')
+    parser.add_argument('--ensemble', type=int, nargs='+', default=[1], help='Numbers of model folders in the ensemble')
+    parser.add_argument('--output', default=None, help='JSON file of the results, printed if not given')
+    args = parser.parse_args()
+    view_sets = [[int(v) for v in views] for views in args.views]
+    benchmark_main(args.size, args.batch_size, args.n_channel, view_sets, args.ensemble, args.output)
@@ -0,0 +1,49 @@
+"""
+Compares the numpy reorientation of load_vtk_image against vtkImageReslice on
+real NIfTI images, for the linear interpolation of images and the nearest
+neighbour interpolation of label maps
+
+@author: Fanwei Kong
+"""
+import os
+import numpy as np
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), "src"))
+import argparse
+import vtk
+from im_utils import nifti_load_reslice
+import parallel_gzip
+from reorient import compare_reslice
+
+def check_main(fns, tol):
+    """
+    Returns:
+        failed: filenames whose output geometry differs or whose largest
+            voxel difference exceeds tol
+    """
+    failed = []
+    for fn in fns:
+        reader = vtk.vtkNIFTIImageReader()
+        with parallel_gzip.decompressed(fn) as nii_fn:
+            reader.SetFileName(nii_fn)
+            reader.Update()
+        print("%s: dimensions %s, spacing %s" % (fn, reader.GetOutput().GetDimensions(), reader.GetOutput().GetSpacing()))
+        for mode in ['linear', 'nearest']:
+            reslice = nifti_load_reslice(reader)
+            if mode == 'nearest':
+                reslice.SetInterpolationModeToNearestNeighbor()
+            print("  %s interpolation:" % mode)
+            diff = compare_reslice(reslice)
+            if np.isnan(diff) or diff > tol:
+                failed.append(fn)
+    return failed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image', nargs='+', help='NIfTI images (.nii or .nii.gz) to check')
+    parser.add_argument('--tol', type=float, default=1., help='Largest accepted voxel difference; integer images may differ by 1 where the interpolated value rounds differently')
+    args = parser.parse_args()
+    failed = check_main(args.image, args.tol)
+    if len(failed) > 0:
+        print("Differences above %g in: %s" % (args.tol, ", ".join(sorted(set(failed)))))
+        sys.exit(1)
@@ -0,0 +1,102 @@
+"""
+Evaluates segmentations against ground truth label maps: Dice and IoU from a
+confusion matrix, and HD95/ASSD surface distances, with the images spread over
+a pool of processes
+
+@author: Fanwei Kong
+"""
+import os
+import numpy as np
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), "src"))
+import argparse
+import csv
+import glob
+import multiprocessing
+import time
+import traceback
+from im_utils import read_label_array
+from metrics import evaluate
+from pre_process import swap_labels_back
+
+METRICS = ['dice', 'iou', 'hd95', 'assd']
+
+def label_filenames(folder):
+    fns = []
+    for ext in ['.nii.gz', '.nii', '.vti', '.mhd']:
+        fns += sorted(glob.glob(os.path.join(folder, '*'+ext)))
+    return fns
+
+def evaluate_pair(job):
+    """
+    Evaluates one segmentation, errors are returned instead of raised so that
+    one broken file does not stop the cohort
+
+    Returns:
+        (pred_fn, true_fn, scores or None, traceback or None, time)
+    """
+    pred_fn, true_fn, surface, swap = job
+    start = time.time()
+    try:
+        pred, _ = read_label_array(pred_fn)
+        true, spacing = read_label_array(true_fn)
+        if pred.shape != true.shape:
+            raise ValueError("Shapes do not match: %s %s and %s %s" % (pred_fn, pred.shape, true_fn, true.shape))
+        if swap:
+            pred = swap_labels_back(true, pred)
+        scores = evaluate(pred, true, spacing, surface)
+        return pred_fn, true_fn, scores, None, time.time()-start
+    except Exception:
+        return pred_fn, true_fn, None, traceback.format_exc(), time.time()-start
+
+def evaluate_main(pred_folder, label_folder, out_fn=None, workers=1, surface=True, swap=False):
+    """
+    Evaluates the segmentations of pred_folder against the label maps of
+    label_folder, paired in sorted filename order
+
+    Returns:
+        rows: list of per image and per class score dictionaries
+        failed: dictionary of segmentation filename to error message
+    """
+    pred_fns = label_filenames(pred_folder)
+    true_fns = label_filenames(label_folder)
+    if len(pred_fns) != len(true_fns):
+        raise ValueError("Found %d segmentations but %d label maps" % (len(pred_fns), len(true_fns)))
+    jobs = [(p, t, surface, swap) for p, t in zip(pred_fns, true_fns)]
+    with multiprocessing.Pool(max(1, workers)) as pool:
+        results = pool.map(evaluate_pair, jobs, chunksize=1)
+
+    rows = []
+    failed = {}
+    for pred_fn, true_fn, scores, err, t in results:
+        if err is not None:
+            failed[pred_fn] = err
+            print("Failed to evaluate %s:\n%s" % (pred_fn, err))
+            continue
+        print("Evaluated %s against %s in %.2f s, foreground Dice %.4f" % (pred_fn, true_fn, t, scores['foreground']['dice']))
+        for c, s in scores.items():
+            rows.append(dict({'segmentation': os.path.basename(pred_fn), 'label': os.path.basename(true_fn), 'class': c}, **s))
+
+    classes = sorted(set([r['class'] for r in rows]), key=str)
+    for c in classes:
+        values = [[r[m] for r in rows if r['class'] == c and m in r] for m in METRICS]
+        print("Class %s: " % c + ", ".join(["mean %s %.4f" % (m, np.nanmean(v)) for m, v in zip(METRICS, values) if len(v) > 0]))
+    if out_fn is not None:
+        with open(out_fn, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=['segmentation', 'label', 'class']+METRICS)
+            writer.writeheader()
+            writer.writerows(rows)
+    return rows, failed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pred', help='Name of the folder containing the segmentations')
+    parser.add_argument('--label', help='Name of the folder containing the ground truth label maps, paired with the segmentations in sorted filename order')
+    parser.add_argument('--output', default=None, help='CSV file of the per image and per class scores')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes evaluating images in parallel')
+    parser.add_argument('--no_surface', action='store_true', help='Skip the surface distances (HD95 and ASSD)')
+    parser.add_argument('--swap_labels', action='store_true', help='Map the predicted ids 0, 1, ... to the sorted ids of the ground truth, as Prediction.dice does')
+    args = parser.parse_args()
+    rows, failed = evaluate_main(args.pred, args.label, args.output, args.workers, not args.no_surface, args.swap_labels)
+    if len(failed) > 0:
+        sys.exit(1)
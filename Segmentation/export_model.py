@@ -0,0 +1,170 @@
+import os
+import numpy as np
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), "src"))
+import argparse
+import time
+import tensorflow as tf
+from tensorflow.python.keras import models as models_keras
+from tensorflow.python.keras import backend as K
+from tensorflow.python.framework import graph_util, tensor_util
+from model import UNet2D
+from frozen_model import FrozenModel
+
+BN_OPS = ['FusedBatchNorm', 'FusedBatchNormV2', 'FusedBatchNormV3']
+
+def _node_name(name):
+    return name.lstrip('^').split(':')[0]
+
+def _const_node(nodes, name):
+    """
+    Follows Identity nodes (left over from frozen variables) up to the constant
+    """
+    node = nodes[_node_name(name)]
+    while node.op == 'Identity':
+        node = nodes[_node_name(node.input[0])]
+    if node.op != 'Const':
+        return None
+    return node
+
+def _make_const(name, value):
+    node = tf.NodeDef()
+    node.name = name
+    node.op = 'Const'
+    node.attr['dtype'].type = tf.float32.as_datatype_enum
+    node.attr['value'].tensor.CopyFrom(tensor_util.make_tensor_proto(value.astype(np.float32), dtype=tf.float32, shape=value.shape))
+    return node
+
+def fold_batch_norms(graph_def):
+    """
+    Folds inference-mode batch normalizations that directly follow a
+    convolution + bias into the convolution kernel and bias.
+    Batch normalizations of other inputs (e.g. the concatenated skip
+    connections in the decoder) are kept.
+
+    Args:
+        graph_def: frozen GraphDef
+    Returns:
+        graph_def: GraphDef with the foldable batch normalizations removed
+        num_folded: number of folded batch normalizations
+    """
+    nodes = {n.name: n for n in graph_def.node}
+    new_consts = []
+    rename = {}
+    for bn in graph_def.node:
+        if bn.op not in BN_OPS or bn.attr['is_training'].b:
+            continue
+        bias_add = nodes[_node_name(bn.input[0])]
+        if bias_add.op != 'BiasAdd':
+            continue
+        conv = nodes[_node_name(bias_add.input[0])]
+        if conv.op == 'Conv2D':
+            out_axis = 3
+        elif conv.op == 'Conv2DBackpropInput':
+            out_axis = 2
+        else:
+            continue
+        kernel_node = _const_node(nodes, conv.input[1])
+        bias_node = _const_node(nodes, bias_add.input[1])
+        params = [_const_node(nodes, i) for i in bn.input[1:5]]
+        if kernel_node is None or bias_node is None or any(p is None for p in params):
+            continue
+        gamma, beta, mean, var = [tensor_util.MakeNdarray(p.attr['value'].tensor) for p in params]
+        scale = gamma / np.sqrt(var + bn.attr['epsilon'].f)
+        shape = [1, 1, 1, 1]
+        shape[out_axis] = -1
+        kernel = tensor_util.MakeNdarray(kernel_node.attr['value'].tensor) * scale.reshape(shape)
+        bias = (tensor_util.MakeNdarray(bias_node.attr['value'].tensor) - mean) * scale + beta
+        new_consts.append(_make_const(conv.name + '/folded_kernel', kernel))
+        new_consts.append(_make_const(bias_add.name + '/folded_bias', bias))
+        conv.input[1] = new_consts[-2].name
+        bias_add.input[1] = new_consts[-1].name
+        rename[bn.name] = bias_add.name
+
+    out = tf.GraphDef()
+    for node in graph_def.node:
+        if node.name in rename:
+            continue
+        new_node = out.node.add()
+        new_node.CopyFrom(node)
+        for i, name in enumerate(node.input):
+            # only the first output (y) of a batch normalization is consumed
+            if _node_name(name) in rename:
+                new_node.input[i] = ('^' if name.startswith('^') else '') + rename[_node_name(name)]
+    out.node.extend(new_consts)
+    return out, len(rename)
+
+def freeze_unet(weight_fn, img_shape, num_class):
+    """
+    Builds the UNet2D in inference mode, loads the weights and freezes it into
+    a GraphDef with the batch normalizations folded and constants pre-folded.
+
+    Returns:
+        graph_def: frozen GraphDef, the output node is named FrozenModel.output_name
+    """
+    K.clear_session()
+    K.set_learning_phase(0)
+    inputs, outputs = UNet2D(img_shape, num_class)
+    unet = models_keras.Model(inputs=[inputs], outputs=[outputs])
+    unet.load_weights(weight_fn)
+    sess = K.get_session()
+    output = tf.identity(unet.outputs[0], name=FrozenModel.output_name)
+    graph_def = graph_util.convert_variables_to_constants(sess, sess.graph.as_graph_def(), [output.op.name])
+    graph_def = graph_util.remove_training_nodes(graph_def, protected_nodes=[output.op.name])
+    graph_def, num_folded = fold_batch_norms(graph_def)
+    graph_def = graph_util.extract_sub_graph(graph_def, [output.op.name])
+    try:
+        from tensorflow.tools.graph_transforms import TransformGraph
+        graph_def = TransformGraph(graph_def, [unet.inputs[0].op.name], [output.op.name], ['fold_constants(ignore_errors=true)', 'strip_unused_nodes', 'sort_by_execution_order'])
+    except ImportError as e:
+        print("Graph transforms are not available, constants are not pre-folded: ", e)
+    print("Folded %d batch normalizations of %s" % (num_folded, weight_fn))
+    return graph_def, unet
+
+def compare_models(keras_model, frozen_model, img_shape, batch_size=4):
+    """
+    Compares the outputs of the Keras model and the frozen graph on random slices
+    """
+    x = np.random.uniform(-1., 1., size=(batch_size,)+tuple(img_shape)).astype(np.float32)
+    start = time.time()
+    p_keras = keras_model.predict(x, batch_size=batch_size)
+    t_keras = time.time() - start
+    start = time.time()
+    p_frozen = frozen_model.predict(x)
+    t_frozen = time.time() - start
+    diff = np.max(np.abs(p_keras - p_frozen))
+    agree = np.mean(np.argmax(p_keras, axis=-1) == np.argmax(p_frozen, axis=-1))
+    print("Max abs difference %.2e, label agreement %.4f, Keras %.1f slices/s, frozen %.1f slices/s" % (diff, agree, batch_size/t_keras, batch_size/t_frozen))
+    return diff, agree
+
+def export_main(model_folders, views, size, channel, model_postfix="small2", check=False):
+    names = ['axial', 'coronal', 'sagittal']
+    img_shape = (size, size, channel)
+    num_class = 8
+    for mdl in model_folders:
+        for v in views:
+            weight_fn = os.path.join(mdl, 'weights_multi-all-%s_%s.hdf5' % (names[v], model_postfix))
+            out_fn = os.path.splitext(weight_fn)[0] + '.pb'
+            graph_def, unet = freeze_unet(weight_fn, img_shape, num_class)
+            with tf.gfile.GFile(out_fn, 'wb') as f:
+                f.write(graph_def.SerializeToString())
+            print("Exported %s to %s" % (weight_fn, out_fn))
+            if check:
+                start = time.time()
+                frozen = FrozenModel(out_fn)
+                print("Loaded frozen graph in %.2f s" % (time.time()-start))
+                # warm up both paths before timing
+                compare_models(unet, frozen, img_shape, 1)
+                compare_models(unet, frozen, img_shape)
+                frozen.close()
+    return
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', nargs='+',  help='Name of the folders containing the trained models')
+    parser.add_argument('--view', type=int, nargs='+', help='List of views to export, split by space. For example, 0 1 2  axial(0), coronal(1), sagittal(2)')
+    parser.add_argument('--size', type=int,default=256, help='Size of images')
+    parser.add_argument('--n_channel',type=int, default=1, help='Number of image channels of input')
+    parser.add_argument('--check', action='store_true', help='Compare the outputs and throughput of the exported graphs against the Keras models')
+    args = parser.parse_args()
+    export_main(args.model, args.view, args.size, args.n_channel, check=args.check)
@@ -5,32 +5,195 @@ sys.path.append(os.path.join(os.path.dirname(__file__), "src"))
 import gc
 import glob
 import tensorflow as tf
-from tensorflow.python.keras import models as models_keras
 from tensorflow.python.keras import backend as K
 
-import vtk
-from pre_process import swap_labels_back, rescale_intensity, vtk_resample_to_size, vtk_resample_with_info_dict
-from im_utils import load_vtk_image, write_vtk_image, get_array_from_vtkImage,get_vtkImage_from_array,vtk_write_mask_as_nifty
-from model import UNet2D
+from pre_process import swap_labels_back, rescale_intensity, resample_to_size, resample_with_info_dict, resample_labels_streamed
+from im_utils import load_vtk_image, write_vtk_image, get_array_from_vtkImage,vtk_write_mask_as_nifty, read_nifti_header, nifti_reslice_axes, reslice_mask_to_nifti, read_label_array
+from model_pool import ModelPool
+from pipeline import Pipeline
+from input_cache import InputCache
+from member_cache import MemberCache
+from prob_io import ProbabilityWriter, probability_filenames
+from metrics import confusion_matrix, dice_from_confusion, foreground_dice
 import argparse
 import time
+import multiprocessing
+import traceback
 
-def model_output_no_resize(model, im_vol, view, channel):
+def available_memory():
+    """
+    Returns the number of bytes of physical memory currently available, or None
+    if it cannot be determined on this platform
+    """
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def auto_batch_size(slice_shape, channel, num_class, mem_fraction=0.25, max_batch=64):
+    """
+    Picks the number of slices per model.predict call from the available RAM
+
+    Args:
+        slice_shape: (height, width) of one slice
+        channel: number of input channels
+        num_class: number of output classes
+        mem_fraction: fraction of the available memory to use for one batch
+        max_batch: upper bound of the batch size
+    Returns:
+        batch_size: number of slices per batch
+    """
+    mem = available_memory()
+    if mem is None:
+        return 1
+    # input, output and roughly six full-resolution 32-filter feature maps of the UNet per slice
+    bytes_per_slice = np.prod(slice_shape) * 4 * (channel + num_class + 6*32)
+    return int(max(1, min(max_batch, mem * mem_fraction // bytes_per_slice)))
+
+def parse_batch_size(value):
+    if str(value).lower() == 'auto':
+        return 'auto'
+    value = int(value)
+    if value < 1:
+        raise argparse.ArgumentTypeError("Batch size should be a positive integer or auto")
+    return value
+
+def slice_batches(im_vol, channel, batch_size, slices=None):
+    """
+    Builds the network inputs of batches of slices on demand
+
+    Args:
+        im_vol: image volume to slice along the first axis
+        channel: number of neighbouring slices stacked as input channels
+        batch_size: number of slices per batch
+        slices: indices of the slices to build, by default all slices
+    Returns:
+        generator of (ids, batch), batch is a float32 [len(ids), H, W, channel] array
+    """
+    num = im_vol.shape[0]
+    if slices is None:
+        slices = np.arange(num)
+    #channel i of slice k is slice k+i-shift. If on boundary, fuse with
+    #the slice on the other boundary (same as np.roll)
+    offsets = np.arange(channel) - int((channel-1)/2)
+    for start in range(0, len(slices), batch_size):
+        ids = np.asarray(slices[start:start+batch_size])
+        src = (ids[:, np.newaxis] + offsets[np.newaxis, :]) % num
+        batch = np.moveaxis(im_vol[src], 1, -1)
+        yield ids, np.ascontiguousarray(batch, dtype=np.float32)
+
+def model_output_no_resize(model, im_vol, view, channel, batch_size=1, out=None, slices=None):
+    """
+    Predicts the class probabilities of the slices of im_vol along view
+
+    Args:
+        model: network (or any object with a Keras-style predict)
+        im_vol: normalized image volume
+        view: axis to slice the volume along
+        channel: number of neighbouring slices stacked as input channels
+        batch_size: number of slices per predict call, or 'auto'
+        out: optional [*im_vol.shape, num_class] array; the probabilities are
+            added to it in place instead of being returned in a new float64 array
+        slices: indices of the slices to predict along view, by default all;
+            the other slices of out are left untouched
+    Returns:
+        out: probabilities (or the updated accumulator)
+        time: prediction time in seconds
+    """
+    num_class = model.output_shape[-1]
+    if out is None:
+        out = np.zeros(list(im_vol.shape)+[num_class])
+    out_view = np.moveaxis(out, view, 0)
     im_vol = np.moveaxis(im_vol, view, 0)
-    ipt = np.zeros([*im_vol.shape,channel])
-    #shift array by channel num. If on boundary, fuse with
-    #the slice on the other boundary
-    shift = int((channel-1)/2)
-    for i in range(channel):
-        ipt[:,:,:,i] = np.roll(im_vol, shift-i, axis=0)
+    if batch_size == 'auto':
+        batch_size = auto_batch_size(im_vol.shape[1:], channel, num_class)
+    num = im_vol.shape[0] if slices is None else len(slices)
     start = time.time()
-    prob = np.zeros(list(ipt.shape[:-1])+[model.layers[-1].output_shape[-1]])
-    for i in range(prob.shape[0]):
-        slice_im = np.expand_dims(ipt[i,:,:,:],axis=0)
-        prob[i,:,:,:] = model.predict(slice_im)
+    for ids, batch in slice_batches(im_vol, channel, batch_size, slices):
+        out_view[ids] += model.predict(batch, batch_size=len(batch))
     end = time.time()
-    prob = np.moveaxis(prob, 0, view)
-    return prob, end-start
+    print("View %d: %d slices in %.2f s (%.1f slices/s, batch size %d)" % (view, num, end-start, num/max(end-start, 1e-6), batch_size))
+    return out, end-start
+
+def model_output_phases(model, im_vols, view, channel, batch_size=1, outs=None):
+    """
+    Predicts the slices of several volumes of the same shape (the phases of a
+    4D series) along view; every batch holds the same slices of all phases
+
+    Args:
+        model: network (or any object with a Keras-style predict)
+        im_vols: list of normalized image volumes
+        view: axis to slice the volumes along
+        channel: number of neighbouring slices stacked as input channels
+        batch_size: total number of slices per predict call, or 'auto'
+        outs: optional list of accumulators, one per volume, see
+            model_output_no_resize
+    Returns:
+        outs: probabilities (or the updated accumulators)
+        time: prediction time in seconds
+    """
+    num_class = model.output_shape[-1]
+    if outs is None:
+        outs = [np.zeros(list(im_vol.shape)+[num_class]) for im_vol in im_vols]
+    out_views = [np.moveaxis(out, view, 0) for out in outs]
+    vols = [np.moveaxis(im_vol, view, 0) for im_vol in im_vols]
+    if batch_size == 'auto':
+        batch_size = auto_batch_size(vols[0].shape[1:], channel, num_class)
+    per_phase = max(1, batch_size // len(vols))
+    start = time.time()
+    for parts in zip(*[slice_batches(vol, channel, per_phase) for vol in vols]):
+        ids = parts[0][0]
+        prob = model.predict(np.concatenate([batch for _, batch in parts]), batch_size=per_phase*len(vols))
+        for j, out_view in enumerate(out_views):
+            out_view[ids] += prob[j*len(ids):(j+1)*len(ids)]
+    end = time.time()
+    num = vols[0].shape[0] * len(vols)
+    print("View %d: %d slices of %d phases in %.2f s (%.1f slices/s, batch size %d)" % (view, num, len(vols), end-start, num/max(end-start, 1e-6), per_phase*len(vols)))
+    return outs, end-start
+
+def empty_slices(im_vol, view, channel=1, tol=1e-3):
+    """
+    Finds the slices along view whose normalized intensity range is below tol
+    (resampling padding or air), together with all their neighbouring input
+    channels
+
+    Returns:
+        empty: boolean array with one value per slice
+    """
+    in_plane = tuple(a for a in range(3) if a != view)
+    empty = (np.max(im_vol, axis=in_plane) - np.min(im_vol, axis=in_plane)) <= tol
+    shift = int((channel-1)/2)
+    #the network input of a slice also contains its neighbours (wrapped around)
+    return np.all([np.roll(empty, shift-i) for i in range(channel)], axis=0)
+
+def uncertain_voxels(prob, count=None, metric='entropy', threshold=0.2, chunk=16):
+    """
+    Finds the voxels whose averaged class probabilities are uncertain
+
+    Args:
+        prob: summed probabilities [x, y, z, num_class]
+        count: number of predictions summed per voxel, scalar or [x, y, z]
+        metric: 'entropy' (entropy normalized to [0, 1]) or 'margin'
+            (1 - difference between the two largest probabilities)
+        threshold: voxels whose uncertainty exceeds threshold are returned
+        chunk: number of slices along the first axis processed at once
+    Returns:
+        mask: boolean [x, y, z] array
+    """
+    mask = np.zeros(prob.shape[:-1], dtype=bool)
+    for i in range(0, prob.shape[0], chunk):
+        p = prob[i:i+chunk].astype(np.float32)
+        if count is not None:
+            p /= (count[i:i+chunk, ..., np.newaxis] if np.ndim(count) > 0 else count)
+        if metric == 'entropy':
+            u = -np.sum(p * np.log(np.clip(p, 1e-7, 1.)), axis=-1) / np.log(p.shape[-1])
+        elif metric == 'margin':
+            top2 = np.partition(p, -2, axis=-1)[..., -2:]
+            u = 1. - (top2[..., 1] - top2[..., 0])
+        else:
+            raise ValueError("Uncertainty metric not recognized: %s" % metric)
+        mask[i:i+chunk] = u > threshold
+    return mask
 
 def predict_volume(prob,labels):
     #im_vol, ori_shape, info = data_preprocess_test(image_vol_fn, view, 256, modality)
@@ -39,86 +202,256 @@ def predict_volume(prob,labels):
     return predicted_label
 
 def dice_score(pred, true):
-    pred = pred.astype(np.int)
-    true = true.astype(np.int)  
-    num_class = np.unique(true)
-    
-    #change to one hot
-    dice_out = [None]*len(num_class)
-    for i in range(1, len(num_class)):
-        pred_c = pred == num_class[i]
-        true_c = true == num_class[i]
-        dice_out[i] = np.sum(pred_c*true_c)*2.0 / (np.sum(pred_c) + np.sum(true_c))
-    
-    mask =( pred > 0 )+ (true > 0)
-    dice_out[0] = np.sum((pred==true)[mask]) * 2. / (np.sum(pred>0) + np.sum(true>0))
+    """
+    Dice score of every label present in true, from one confusion matrix pass.
+    The first entry (background) is replaced by the Dice score over all
+    non-zero labels.
+    """
+    cm = confusion_matrix(pred, true)
+    num_class = np.nonzero(cm.sum(axis=1))[0]
+    dice = dice_from_confusion(cm)
+    dice_out = [dice[c] for c in num_class]
+    dice_out[0] = foreground_dice(cm)
     return dice_out
 
 class Prediction:
     #This is a class to get 3D volumetric prediction from the 2DUNet model
-    def __init__(self, unet, model,modality,view,image_fn,label_fn, channel):
-        self.unet=unet
+    def __init__(self, pool, model,modality,view,image_fn,label_fn, channel, batch_size=1, prob_dtype=np.float64, cascade=None, cascade_threshold=0.2, roi_stride=None, roi_margin=10, skip_empty=False, input_cache=None, gzip_level=None, stream_resample=False, save_prob=False, member_cache=None):
+        self.pool=pool
         self.models=model
         self.modality=modality
         self.views=view
         self.image_fn = image_fn
         self.channel = channel
+        self.batch_size = batch_size
+        self.prob_dtype = prob_dtype
+        self.cascade = cascade
+        self.cascade_threshold = cascade_threshold
+        self.roi_stride = roi_stride
+        self.roi_margin = roi_margin
+        self.skip_empty = skip_empty
+        self.input_cache = input_cache
+        self.gzip_level = gzip_level
+        self.stream_resample = stream_resample
+        self.save_prob = save_prob
+        self.member_cache = member_cache
+        self.image_info = {}
         self.label_fn = label_fn
         self.prediction = None
+        #self.pred is in the orientation of the NIfTI input file
+        self.pred_oriented = False
         self.dice_score = None
         self.original_shape = None
         assert len(self.models)==len(self.views), "Missing view attributes for models"
     def prepare_input_vtk(self, size):
-        vtk_img = load_vtk_image(self.image_fn)
+        if self.input_cache is not None:
+            key = self.input_cache.key(self.image_fn, size, self.modality)
+            cached = self.input_cache.load(key)
+            if cached is not None:
+                print("Using cached input of "+self.image_fn)
+                img_vol, self.image_info = cached
+                return img_vol
+        header = {}
+        vtk_img = load_vtk_image(self.image_fn, header)
         self.image_info = {}
+        #orientation metadata reused when writing, avoids reading the image again
+        self.image_info['nifti'] = header
         self.image_info['spacing'] = vtk_img.GetSpacing()
         self.image_info['origin'] = vtk_img.GetOrigin()
         self.image_info['extent'] = vtk_img.GetExtent()
         self.image_info['size'] = vtk_img.GetDimensions()
-        vtk_img = vtk_resample_to_size(vtk_img, (size, size, size))
-        img_vol = get_array_from_vtkImage(vtk_img)
+        #the resampling plan is shared by all images of the same geometry
+        img_vol = resample_to_size(vtk_img, (size, size, size))
         img_vol = rescale_intensity(img_vol,self.modality, [750, -750])
+        #one normalized float32 volume is shared by all views and models
+        img_vol.setflags(write=False)
+        if self.input_cache is not None:
+            self.input_cache.store(key, img_vol, self.image_info)
         return img_vol
-    def volume_prediction_average(self, size):
+    def volume_prediction_average(self, size, img_vol=None, prob_fn=None):
+        """
+        Averages the predictions of all ensemble members.
+
+        The probabilities of every model are added in place to a single
+        [size, size, size, 8] accumulator of dtype self.prob_dtype; no per-view
+        or per-model volume is kept. For 256^3 volumes this replaces the former
+        float64 prob, prob_view, per-model output and average arrays (about
+        4 GiB at peak) by one accumulator of 1 GiB (float64), 512 MiB (float32)
+        or 256 MiB (float16), plus the input slices of one view.
 
-        img_vol = self.prepare_input_vtk(size)
+        With self.cascade, the first view runs on all slices and the later views
+        only on the slices containing voxels whose uncertainty (self.cascade
+        metric, see uncertain_voxels) exceeds self.cascade_threshold. The
+        average then uses the number of predictions of each voxel.
+
+        With self.roi_stride, a coarse pass first locates the foreground (see
+        find_roi) and the ensemble only runs on the slices intersecting it;
+        everything outside is set to background.
+
+        With prob_fn, the average probabilities are also written to prob_fn as
+        uint8 (see prob_io.ProbabilityWriter) after every view. Voxels that
+        were not predicted (outside the region of interest) are all zero.
+
+        With self.member_cache, the probabilities of every ensemble member are
+        read from the cache when present (the network is not even loaded), and
+        otherwise predicted and stored, both quantized to uint8. The cache is
+        not used with the cascade or the region of interest, whose member
+        predictions depend on the other members.
+        """
+        if img_vol is None:
+            img_vol = self.prepare_input_vtk(size)
         
         self.original_shape = img_vol.shape
         
-        prob = np.zeros((*self.original_shape,8))
-        unique_views = np.unique(self.views)
+        views = np.asarray(self.views)
+        unique_views = np.unique(views)
+        count = None
         
         self.pred_time = 0.
-        for view in unique_views:
-            indices = np.where(self.views==view)[0]
-            predict_shape = [size,size,size,8]
-            predict_shape[view] = img_vol.shape[view]
-            prob_view = np.zeros(predict_shape)
+        self.skipped_slices = 0
+        roi = self.find_roi(img_vol) if self.roi_stride else None
+        prob = np.zeros((*self.original_shape,8), dtype=self.prob_dtype)
+        writer = None
+        if prob_fn is not None:
+            writer = ProbabilityWriter(prob_fn, self.original_shape, prob.shape[-1], self.image_info)
+        done = 0
+        member_cache = self.member_cache
+        if member_cache is not None and (self.cascade or roi is not None or self.image_fn is None):
+            print("The member cache is not used with the cascade, the region of interest or in-memory images")
+            member_cache = None
+        self.cached_members = 0
+        for k, view in enumerate(unique_views):
+            indices = np.where(views==view)[0]
+            slices = None
+            if roi is not None:
+                slices = np.arange(*roi[view])
+            if self.cascade and k > 0:
+                if count is None:
+                    count = np.full(self.original_shape, np.sum(views==unique_views[0]), dtype=np.uint8)
+                uncertain = uncertain_voxels(prob, count, self.cascade, self.cascade_threshold)
+                if roi is not None:
+                    in_roi = np.zeros_like(uncertain)
+                    in_roi[tuple(slice(*r) for r in roi)] = True
+                    uncertain &= in_roi
+                in_plane = tuple(a for a in range(3) if a != view)
+                slices = np.where(np.any(uncertain, axis=in_plane))[0]
+                del uncertain
+                np.moveaxis(count, view, 0)[slices] += len(indices)
+            background = []
+            if self.skip_empty:
+                run = np.arange(img_vol.shape[view]) if slices is None else slices
+                empty = empty_slices(img_vol, view, self.channel)[run]
+                background, slices = run[empty], run[~empty]
+                print("View %d: skipping %d empty slices" % (view, len(background)))
+            if slices is not None:
+                self.skipped_slices += (img_vol.shape[view]-len(slices)) * len(indices)
             for i in indices:
                 model_path = self.models[i]
-                (self.unet).load_weights(model_path)
-                p, t = model_output_no_resize(self.unet, img_vol, self.views[i], self.channel)
-                prob_view += p
+                key = None
+                if member_cache is not None:
+                    key = member_cache.key(model_path, self.image_fn, view, size, self.modality, self.channel, self.skip_empty)
+                    cached = member_cache.load(key)
+                    if cached is not None:
+                        member_cache.accumulate(prob, cached[0])
+                        self.cached_members += 1
+                        continue
+                unet = self.pool.get(model_path)
+                out = prob if key is None else np.zeros_like(prob)
+                out, t = model_output_no_resize(unet, img_vol, self.views[i], self.channel, self.batch_size, out=out, slices=slices)
+                #empty slices are predicted as background
+                np.moveaxis(out, view, 0)[background, ..., 0] += 1
+                if key is not None:
+                    member_cache.accumulate(prob, member_cache.store(key, out, {'weights': model_path, 'image': self.image_fn, 'view': int(view)}))
+                    del out
                 self.pred_time += t
-            prob += prob_view
-        avg = prob/len(self.models)
-        self.pred = predict_volume(avg, np.zeros(1))
+            done += len(indices)
+            if writer is not None:
+                writer.update(prob, done if count is None else count, unique_views[:k+1])
+        if writer is not None:
+            writer.close()
+            print("Wrote probabilities to "+prob_fn)
+        if member_cache is not None:
+            print("Reused %d of %d ensemble members from the member cache" % (self.cached_members, len(self.models)))
+        if count is not None:
+            prob /= count[..., np.newaxis]
+        if count is not None or roi is not None or self.skip_empty:
+            total = sum([img_vol.shape[v] for v in self.views])
+            print("Skipped %d of %d slice inferences (%.1f%%)" % (self.skipped_slices, total, 100.*self.skipped_slices/total))
+        #the argmax of the sum equals the argmax of the average
+        self.pred = predict_volume(prob, np.zeros(1))
+        del prob
+        if roi is not None:
+            #paste the region of interest back into a background volume
+            box = tuple(slice(*r) for r in roi)
+            pred = np.zeros_like(self.pred)
+            pred[box] = self.pred[box]
+            self.pred = pred
         return 
 
+    def find_roi(self, img_vol):
+        """
+        Coarse pass locating the foreground: the first ensemble member predicts
+        every self.roi_stride-th slice along its view, and the bounding box of
+        the foreground voxels is padded by the stride and self.roi_margin.
+
+        Returns:
+            roi: [(start, stop)] slice range along each axis, None if no
+                foreground was found
+        """
+        view = self.views[0]
+        unet = self.pool.get(self.models[0])
+        vol = np.moveaxis(img_vol, view, 0)
+        batch_size = self.batch_size
+        if batch_size == 'auto':
+            batch_size = auto_batch_size(vol.shape[1:], self.channel, unet.output_shape[-1])
+        sampled = np.arange(0, vol.shape[0], self.roi_stride)
+        lower = np.array(vol.shape)
+        upper = np.zeros(3, dtype=int)
+        start = time.time()
+        for ids, batch in slice_batches(vol, self.channel, batch_size, sampled):
+            fg = np.nonzero(np.argmax(unet.predict(batch, batch_size=len(batch)), axis=-1) > 0)
+            if len(fg[0]) == 0:
+                continue
+            coords = np.stack([ids[fg[0]], fg[1], fg[2]])
+            lower = np.minimum(lower, coords.min(axis=1))
+            upper = np.maximum(upper, coords.max(axis=1)+1)
+        self.pred_time += time.time() - start
+        if np.any(upper <= lower):
+            print("No foreground found in the coarse pass, predicting all slices")
+            return None
+        pad = np.array([self.roi_stride-1, 0, 0]) + self.roi_margin
+        lower = np.maximum(lower - pad, 0)
+        upper = np.minimum(upper + pad, vol.shape)
+        #back to the original axis order
+        order = [view] + [a for a in range(3) if a != view]
+        roi = [None]*3
+        for i, a in enumerate(order):
+            roi[a] = (int(lower[i]), int(upper[i]))
+        print("Region of interest: ", roi)
+        return roi
+
     def dice(self):
         #assuming groud truth label has the same origin, spacing and orientation as input image
-        label_vol = sitk.GetArrayFromImage(sitk.ReadImage(self.label_fn))
-        pred_label = sitk.GetArrayFromImage(self.pred)
+        label_vol, _ = read_label_array(self.label_fn)
+        pred = self.pred
+        header = self.image_info.get('nifti')
+        if isinstance(pred, np.ndarray):
+            #prediction on the network grid, mapped to the grid of the input file
+            axes = nifti_reslice_axes(header) if header else None
+            pred = resample_labels_streamed(pred, self.image_info, axes)
+        elif header and not self.pred_oriented:
+            #native grid prediction in the orientation of load_vtk_image, back to the file orientation
+            pred = reslice_mask_to_nifti(pred, header)
+        pred_label = get_array_from_vtkImage(pred)
         pred_label = swap_labels_back(label_vol, pred_label)
-        ds = dice_score(pred_label, label_vol)
-        return ds
+        self.dice_score = dice_score(pred_label, label_vol)
+        return self.dice_score
     
     def resample_prediction_vtk(self):
-        im = get_vtkImage_from_array(self.pred.astype(np.uint8))
-        self.pred = vtk_resample_with_info_dict(im, self.image_info, order=0)
+        self.pred = resample_with_info_dict(self.pred.astype(np.uint8), self.image_info, order=0)
         return 
 
-    def write_prediction(self, out_fn):
+    def write_prediction(self, out_fn, oriented=False):
         if not os.path.isdir(out_fn):
             try:
                 os.makedirs(os.path.dirname(out_fn))
@@ -126,14 +459,199 @@ class Prediction:
         if out_fn[-4:] == '.vti' or out_fn[-4:] == '.mhd':
             write_vtk_image(self.pred, out_fn)
         elif out_fn[-4:] == '.nii' or out_fn[-7:] == '.nii.gz':
-            vtk_write_mask_as_nifty(self.pred, self.image_fn, out_fn)
+            vtk_write_mask_as_nifty(self.pred, self.image_fn, out_fn, self.image_info.get('nifti'), self.gzip_level, oriented)
         else:
             raise IOError("Output file extension not supported: %s" % out_fn)
         return 
 
+    def write_prediction_streamed(self, out_fn, slab=16):
+        """
+        Resamples the prediction to the native grid and, for NIfTI outputs,
+        to the orientation of the input file in one slab-by-slab pass that
+        fills the final uint8 buffer, then writes it
+        """
+        axes = None
+        nifti = out_fn[-4:] == '.nii' or out_fn[-7:] == '.nii.gz'
+        if nifti:
+            if not self.image_info.get('nifti'):
+                self.image_info['nifti'] = read_nifti_header(self.image_fn)
+            axes = nifti_reslice_axes(self.image_info['nifti'])
+        self.pred = resample_labels_streamed(self.pred, self.image_info, axes, slab)
+        self.pred_oriented = nifti
+        self.write_prediction(out_fn, oriented=nifti)
+        return
+
+
+def image_filenames(data_folder, patient_id):
+    ext_list = ['.nii.gz', '.nii', '.vti']
+    x_filenames = []
+    for ext in ext_list:
+        x_filenames += sorted(glob.glob(os.path.join(data_folder, patient_id, '*'+ext)))
+    return x_filenames
+
+def load_image(pool, job):
+    """
+    Load and preprocess stage of one segmentation job
+    """
+    predict = Prediction(pool, job['models'], job['modality'], job['views'], job['image_fn'], None, job['channel'], **job['kwargs'])
+    return predict, predict.prepare_input_vtk(job['size'])
+
+def infer_image(job, loaded):
+    predict, img_vol = loaded
+    prob_fn = probability_filenames(job['out_fn'])[0] if predict.save_prob else None
+    predict.volume_prediction_average(job['size'], img_vol, prob_fn)
+    return predict
+
+def write_image(job, predict):
+    if predict.stream_resample:
+        predict.write_prediction_streamed(job['out_fn'])
+    else:
+        predict.resample_prediction_vtk()
+        predict.write_prediction(job['out_fn'])
 
-def seg_main(size, modality, patient_id, data_folder, data_out_folder, model_folder, view_attributes, channel):
+def segment_image(pool, models, modality, views, image_fn, out_fn, size, channel, **kwargs):
+    """
+    Segments one image with the ensemble and writes the result to out_fn
+    """
+    job = {'models': models, 'modality': modality, 'views': views, 'image_fn': image_fn, 'out_fn': out_fn, 'size': size, 'channel': channel, 'kwargs': kwargs}
+    predict = infer_image(job, load_image(pool, job))
+    write_image(job, predict)
+    return predict
 
+def same_geometry(info1, info2, tol=1e-5):
+    """
+    Whether two image_info dictionaries describe the same native grid and
+    orientation
+    """
+    for k in ['spacing', 'origin', 'extent', 'size']:
+        if not np.allclose(info1[k], info2[k], atol=tol):
+            return False
+    h1, h2 = info1.get('nifti') or {}, info2.get('nifti') or {}
+    for k in ['qform', 'sform']:
+        m1, m2 = h1.get(k), h2.get(k)
+        if (m1 is None) != (m2 is None) or (m1 is not None and not np.allclose(m1, m2, atol=tol)):
+            return False
+    return h1.get('qfac') == h2.get('qfac')
+
+def segment_phases(pool, jobs):
+    """
+    Segments the phases of a 4D series together. The phases sharing the
+    geometry of the first loaded one are predicted model by model, each
+    network running once over all of them with batches interleaving their
+    slices (see model_output_phases); the other phases are segmented on their
+    own. A phase that fails to load or write does not stop the others.
+
+    Returns:
+        results: (image filename, traceback or None, time) of every phase
+    """
+    start = time.time()
+    results = [None]*len(jobs)
+    def done(k, err=None):
+        results[k] = (jobs[k]['image_fn'], err, time.time()-start)
+    loaded = {}
+    for k, job in enumerate(jobs):
+        try:
+            loaded[k] = load_image(pool, job)
+        except Exception:
+            done(k, traceback.format_exc())
+    if len(loaded) == 0:
+        return results
+    first = min(loaded)
+    shared = [k for k in sorted(loaded) if same_geometry(loaded[first][0].image_info, loaded[k][0].image_info)]
+    for k in sorted(loaded):
+        if k in shared:
+            continue
+        print("%s does not share the geometry of %s, segmenting it alone" % (jobs[k]['image_fn'], jobs[first]['image_fn']))
+        try:
+            write_image(jobs[k], infer_image(jobs[k], loaded.pop(k)))
+            done(k)
+        except Exception:
+            done(k, traceback.format_exc())
+    job = jobs[first]
+    predicts = [loaded[k][0] for k in shared]
+    try:
+        vols = [loaded.pop(k)[1] for k in shared]
+        views = np.asarray(job['views'])
+        probs = [np.zeros(vol.shape+(8,), dtype=predicts[0].prob_dtype) for vol in vols]
+        for view in np.unique(views):
+            for i in np.where(views==view)[0]:
+                unet = pool.get(job['models'][i])
+                probs, t = model_output_phases(unet, vols, view, job['channel'], predicts[0].batch_size, probs)
+                for predict in predicts:
+                    predict.pred_time = getattr(predict, 'pred_time', 0.) + t/len(predicts)
+        del vols
+    except Exception:
+        #the inference is shared, all of these phases fail together
+        err = traceback.format_exc()
+        for k in shared:
+            done(k, err)
+        return results
+    for k, predict in zip(shared, predicts):
+        try:
+            #the argmax of the sum equals the argmax of the average
+            predict.pred = predict_volume(probs.pop(0), np.zeros(1))
+            write_image(jobs[k], predict)
+            done(k)
+        except Exception:
+            done(k, traceback.format_exc())
+    return results
+
+def set_tf_threads(intra_threads=None, inter_threads=None):
+    """
+    Starts a new TF session with bounded intra-/inter-op thread pools
+    (None or 0 lets TF decide)
+    """
+    config = tf.ConfigProto(intra_op_parallelism_threads=intra_threads or 0, inter_op_parallelism_threads=inter_threads or 0)
+    K.set_session(tf.Session(config=config))
+    return config
+
+_worker = {}
+
+def _init_worker(img_shape, num_class, max_models, intra_threads, inter_threads):
+    config = set_tf_threads(intra_threads, inter_threads)
+    _worker['pool'] = ModelPool(img_shape, num_class, max_models, config)
+
+def _segment_job(job):
+    image_fn = job['image_fn']
+    start = time.time()
+    try:
+        print("Processing "+image_fn)
+        write_image(job, infer_image(job, load_image(_worker['pool'], job)))
+        return image_fn, None, time.time()-start
+    except Exception:
+        return image_fn, traceback.format_exc(), time.time()-start
+
+def _segment_phase_job(jobs):
+    start = time.time()
+    try:
+        print("Processing phases "+", ".join([job['image_fn'] for job in jobs]))
+        return segment_phases(_worker['pool'], jobs)
+    except Exception:
+        err = traceback.format_exc()
+        return [(job['image_fn'], err, time.time()-start) for job in jobs]
+
+def _segment_pipelined(jobs):
+    pipe = Pipeline(lambda job: load_image(_worker['pool'], job), infer_image, write_image)
+    results = pipe.run(jobs)
+    pipe.report()
+    return [(job['image_fn'], err, t) for job, err, t in results]
+
+def seg_main(size, modality, patient_id, data_folder, data_out_folder, model_folder, view_attributes, channel, batch_size=1, max_models=None, prob_dtype=np.float64, workers=1, intra_threads=None, inter_threads=None, pipeline=False, frozen=False, precision='float32', cascade=None, cascade_threshold=0.2, roi_stride=None, roi_margin=10, skip_empty=False, cache_dir=None, cache_size=None, gzip_level=None, stream_resample=False, save_prob=False, member_cache=None, member_cache_size=None, phases=None):
+    """
+    Segments all images of a patient.
+
+    With workers > 1 the images are spread over a pool of processes, each with
+    its own TF session and model pool. Otherwise, with pipeline, images are
+    loaded and written on background threads while the previous/next image is
+    in inference. A failing image is reported and does not stop the others.
+
+    With phases, the images are the phases of a 4D series and are segmented
+    in groups of that many phases (see segment_phases), which bounds the
+    memory to one accumulator and one input volume per phase of a group.
+
+    Returns:
+        failed: dictionary of image filename to error message
+    """
     model_postfix = "small2"
     model_folders = sorted(model_folder * len(view_attributes))
     view_attributes *= len(model_folder)
@@ -148,25 +666,65 @@ def seg_main(size, modality, patient_id, data_folder, data_out_folder, model_fol
     #set up models
     img_shape = (size, size, channel)
     num_class = 8
-    inputs, outputs = UNet2D(img_shape, num_class)
-    unet = models_keras.Model(inputs=[inputs], outputs=[outputs])
+    if precision == 'int8':
+        model_ext = '.tflite'
+    elif frozen:
+        model_ext = '.pb'
+    else:
+        model_ext = '.hdf5'
+    models = [os.path.join(mdl, 'weights_multi-all-%s_%s%s' % (j, model_postfix, model_ext)) for mdl, j in zip(model_folders, view_names)]
+    pred_kwargs = {'batch_size': batch_size, 'prob_dtype': prob_dtype, 'cascade': cascade, 'cascade_threshold': cascade_threshold, 'roi_stride': roi_stride, 'roi_margin': roi_margin, 'skip_empty': skip_empty, 'gzip_level': gzip_level, 'stream_resample': stream_resample, 'save_prob': save_prob}
+    if cache_dir is not None:
+        pred_kwargs['input_cache'] = InputCache(cache_dir, None if cache_size is None else int(cache_size * 1024**3))
+    if member_cache is not None:
+        pred_kwargs['member_cache'] = MemberCache(member_cache, None if member_cache_size is None else int(member_cache_size * 1024**3))
     
     #load image filenames
-    filenames = {}
-    
-    ext_list = ['.nii.gz', '.nii', '.vti']
+    jobs = []
     for m in modality:
-        x_filenames = []
-        for ext in ext_list:
-            x_filenames += sorted(glob.glob(os.path.join(data_folder, patient_id, '*'+ext)))
-        for i in range(len(x_filenames)):
-            print("Processing "+x_filenames[i])            
-            models = [os.path.join(mdl, 'weights_multi-all-%s_%s.hdf5' % (j, model_postfix)) for mdl, j in zip(model_folders, view_names)]
-            predict = Prediction(unet, models,m,view_attributes,x_filenames[i], None, channel)
-            predict.volume_prediction_average(size)
-            predict.resample_prediction_vtk()
-            predict.write_prediction(os.path.join(data_out_folder,patient_id,os.path.basename(x_filenames[i])))
-    return 
+        for fn in image_filenames(data_folder, patient_id):
+            out_fn = os.path.join(data_out_folder,patient_id,os.path.basename(fn))
+            jobs.append({'models': models, 'modality': m, 'views': view_attributes, 'image_fn': fn, 'out_fn': out_fn, 'size': size, 'channel': channel, 'kwargs': pred_kwargs})
+
+    segment_job = _segment_job
+    if phases:
+        if cascade or roi_stride or skip_empty or save_prob or member_cache is not None or pipeline:
+            raise ValueError("The 4D mode cannot be combined with cascade, roi_stride, skip_empty, save_prob, member_cache or pipeline")
+        #phases of the same modality are segmented together
+        jobs = [[job for job in jobs if job['modality'] == m] for m in modality]
+        jobs = [group[i:i+phases] for group in jobs for i in range(0, len(group), phases)]
+        segment_job = _segment_phase_job
+
+    if workers > 1:
+        if intra_threads is None:
+            intra_threads = max(1, multiprocessing.cpu_count() // workers)
+        if inter_threads is None:
+            inter_threads = 1
+        #TF is not fork-safe, every worker starts a fresh interpreter
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(workers, initializer=_init_worker, initargs=(img_shape, num_class, max_models, intra_threads, inter_threads)) as p:
+            results = p.map(segment_job, jobs, chunksize=1)
+    else:
+        config = None
+        if intra_threads is not None or inter_threads is not None:
+            config = set_tf_threads(intra_threads, inter_threads)
+        _worker['pool'] = ModelPool(img_shape, num_class, max_models, config)
+        if pipeline:
+            results = _segment_pipelined(jobs)
+        else:
+            results = [segment_job(job) for job in jobs]
+    if phases:
+        results = [r for group in results for r in group]
+
+    failed = {}
+    for fn, err, t in results:
+        if err is None:
+            print("Finished %s in %.1f s" % (fn, t))
+        else:
+            print("Failed %s after %.1f s:\n%s" % (fn, t, err))
+            failed[fn] = err
+    print("Segmented %d/%d images" % (len(results)-len(failed), len(results)))
+    return failed
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -178,9 +736,33 @@ if __name__ == '__main__':
     parser.add_argument('--modality', nargs='+', help='Name of the modality, mr, ct, split by space')
     parser.add_argument('--size', type=int,default=256, help='Size of images')
     parser.add_argument('--n_channel',type=int, default=1, help='Number of image channels of input')
+    parser.add_argument('--batch_size', type=parse_batch_size, default=1, help='Number of slices per model prediction call, or auto to size it from the available RAM')
+    parser.add_argument('--max_models', type=int, default=None, help='Maximum number of networks kept in memory, by default all ensemble members stay resident')
+    parser.add_argument('--prob_dtype', default='float64', choices=['float64', 'float32', 'float16'], help='Data type of the probability accumulator, float32 or float16 reduce the peak memory')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes segmenting images in parallel')
+    parser.add_argument('--intra_threads', type=int, default=None, help='TF intra-op threads per process, by default the CPU count divided by the number of workers')
+    parser.add_argument('--inter_threads', type=int, default=None, help='TF inter-op threads per process')
+    parser.add_argument('--pipeline', action='store_true', help='Load the next image and write the previous one on background threads during inference (single process only)')
+    parser.add_argument('--frozen', action='store_true', help='Use the frozen inference graphs (.pb) written by export_model.py instead of the Keras weights')
+    parser.add_argument('--precision', default='float32', choices=['float32', 'int8'], help='Use the float networks or the int8 quantized networks (.tflite) written by quantize_model.py')
+    parser.add_argument('--cascade', default=None, choices=['entropy', 'margin'], help='Run the views after the first one only on slices with uncertain voxels, using this uncertainty metric')
+    parser.add_argument('--cascade_threshold', type=float, default=0.2, help='Uncertainty (normalized entropy or 1 - margin) above which a voxel is sent to the next views')
+    parser.add_argument('--roi_stride', type=int, default=None, help='Locate the heart with a coarse pass over every roi_stride-th slice of the first view, then predict only the slices intersecting it')
+    parser.add_argument('--roi_margin', type=int, default=10, help='Margin in voxels added around the region of interest')
+    parser.add_argument('--skip_empty', action='store_true', help='Do not run the networks on slices of constant intensity (padding or air) and label them background')
+    parser.add_argument('--cache_dir', default=None, help='Directory caching the preprocessed network inputs, reused by later runs on the same images')
+    parser.add_argument('--cache_size', type=float, default=None, help='Maximum size of the input cache in GB, least recently used entries are removed first')
+    parser.add_argument('--gzip_level', type=int, default=None, choices=range(10), help='Compression level of .nii.gz segmentations, compressed in parallel blocks, 6 if not given')
+    parser.add_argument('--stream_resample', action='store_true', help='Resample the segmentations back to the native grid and orientation slab by slab, bounding the memory for large images')
+    parser.add_argument('--save_prob', action='store_true', help='Also write the averaged class probabilities as memory-mappable uint8 arrays (<name>_prob.npy and <name>_prob.json) next to the segmentations')
+    parser.add_argument('--member_cache', default=None, help='Directory caching the uint8 probabilities of every ensemble member on every image, so that only new members are run')
+    parser.add_argument('--member_cache_size', type=float, default=None, help='Maximum size of the member cache in GB, least recently used entries are removed first')
+    parser.add_argument('--phases', type=int, default=None, help='4D mode: segment the images of the patient as phases of one series, this many at a time, with batches interleaving the slices of all phases')
     args = parser.parse_args()
 
     if args.pid.lower() == "none":
         args.pid = ''
     
-    seg_main(args.size, args.modality, args.pid, args.image, args.output, args.model, args.view, args.n_channel)
+    failed = seg_main(args.size, args.modality, args.pid, args.image, args.output, args.model, args.view, args.n_channel, args.batch_size, args.max_models, np.dtype(args.prob_dtype), args.workers, args.intra_threads, args.inter_threads, args.pipeline, args.frozen, args.precision, args.cascade, args.cascade_threshold, args.roi_stride, args.roi_margin, args.skip_empty, args.cache_dir, args.cache_size, args.gzip_level, args.stream_resample, args.save_prob, args.member_cache, args.member_cache_size, args.phases)
+    if len(failed) > 0:
+        sys.exit(1)
@@ -0,0 +1,130 @@
+import os
+import numpy as np
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), "src"))
+import argparse
+import tempfile
+import tensorflow as tf
+from tensorflow.python.keras import models as models_keras
+from tensorflow.python.keras import backend as K
+from model import UNet2D
+from frozen_model import QuantizedModel
+from prediction import Prediction, model_output_no_resize, slice_batches
+from metrics import confusion_matrix, dice_from_confusion, foreground_dice
+
+def load_sample_volumes(image_fns, modality, size):
+    vols = []
+    for fn in image_fns:
+        print("Loading sample volume "+fn)
+        predict = Prediction(None, [], modality, [], fn, None, 1)
+        vols.append(predict.prepare_input_vtk(size))
+    return vols
+
+def representative_slices(vols, view, channel, num_slices):
+    """
+    Generator of calibration inputs: num_slices evenly spaced slices per volume
+    """
+    def gen():
+        for vol in vols:
+            vol = np.moveaxis(vol, view, 0)
+            step = max(1, vol.shape[0] // num_slices)
+            #neighbour channels come from the full volume, as in inference
+            for _, batch in slice_batches(vol, channel, 1, slices=np.arange(0, vol.shape[0], step)):
+                yield [batch]
+    return gen
+
+def quantize_unet(weight_fn, img_shape, num_class, calibration):
+    """
+    Converts the Keras weights to an int8 TFLite model calibrated on the
+    representative slices
+
+    Returns:
+        tflite_model: serialized TFLite model
+        unet: the float Keras model
+    """
+    K.clear_session()
+    K.set_learning_phase(0)
+    inputs, outputs = UNet2D(img_shape, num_class)
+    unet = models_keras.Model(inputs=[inputs], outputs=[outputs])
+    unet.load_weights(weight_fn)
+    converter = tf.lite.TFLiteConverter.from_session(K.get_session(), unet.inputs, unet.outputs)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = tf.lite.RepresentativeDataset(calibration)
+    return converter.convert(), unet
+
+def compare_dice(float_model, int8_model, vols, view, channel, batch_size=1):
+    """
+    Per class Dice scores of the int8 labels against the float labels, the
+    lowest score over all volumes is kept for every class. Every class
+    predicted by either model is scored; the foreground score of a volume
+    where neither model predicts any foreground is undefined and skipped.
+    """
+    scores = {}
+    for vol in vols:
+        labels = []
+        for model in [float_model, int8_model]:
+            prob = np.zeros(vol.shape+(model.output_shape[-1],), dtype=np.float32)
+            prob, _ = model_output_no_resize(model, vol, view, channel, batch_size, out=prob)
+            labels.append(np.argmax(prob, axis=-1))
+        cm = confusion_matrix(labels[1], labels[0])
+        dice = dice_from_confusion(cm)
+        vol_scores = {'foreground': foreground_dice(cm)}
+        for c in np.nonzero(cm.sum(axis=0) + cm.sum(axis=1))[0]:
+            if c != 0:
+                vol_scores[int(c)] = dice[c]
+        for c, score in vol_scores.items():
+            if np.isnan(score):
+                continue
+            scores[c] = min(scores[c], score) if c in scores else score
+    return scores
+
+def quantize_main(model_folders, views, image_fns, eval_fns, modality, size, channel, min_dice, num_slices=16, model_postfix="small2"):
+    """
+    Quantizes every weight file and keeps the int8 model only if the Dice score
+    of every class against the float model stays above min_dice
+
+    Returns:
+        refused: list of weight files whose quantized model was refused
+    """
+    names = ['axial', 'coronal', 'sagittal']
+    img_shape = (size, size, channel)
+    num_class = 8
+    calib_vols = load_sample_volumes(image_fns, modality, size)
+    eval_vols = load_sample_volumes(eval_fns, modality, size) if eval_fns else calib_vols
+    refused = []
+    for mdl in model_folders:
+        for v in views:
+            weight_fn = os.path.join(mdl, 'weights_multi-all-%s_%s.hdf5' % (names[v], model_postfix))
+            out_fn = os.path.splitext(weight_fn)[0] + '.tflite'
+            tflite_model, unet = quantize_unet(weight_fn, img_shape, num_class, representative_slices(calib_vols, v, channel, num_slices))
+            fd, tmp_fn = tempfile.mkstemp(suffix='.tflite', dir=mdl)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(tflite_model)
+            scores = compare_dice(unet, QuantizedModel(tmp_fn), eval_vols, v, channel)
+            failed = {c: s for c, s in scores.items() if s < min_dice}
+            for c, s in sorted(scores.items(), key=lambda x: str(x[0])):
+                print("%s class %s: Dice %.4f" % (os.path.basename(weight_fn), c, s))
+            if len(failed) > 0:
+                os.remove(tmp_fn)
+                refused.append(weight_fn)
+                print("Refused int8 model of %s, classes below Dice %.3f: %s" % (weight_fn, min_dice, sorted(failed, key=str)))
+            else:
+                os.rename(tmp_fn, out_fn)
+                print("Wrote int8 model %s" % out_fn)
+    return refused
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', nargs='+',  help='Name of the folders containing the trained models')
+    parser.add_argument('--view', type=int, nargs='+', help='List of views to quantize, split by space. For example, 0 1 2  axial(0), coronal(1), sagittal(2)')
+    parser.add_argument('--image', nargs='+', help='Sample image volumes used for calibration')
+    parser.add_argument('--eval_image', nargs='+', default=None, help='Image volumes used for the Dice comparison, by default the calibration volumes')
+    parser.add_argument('--modality', help='Name of the modality, mr or ct')
+    parser.add_argument('--size', type=int,default=256, help='Size of images')
+    parser.add_argument('--n_channel',type=int, default=1, help='Number of image channels of input')
+    parser.add_argument('--num_slices', type=int, default=16, help='Number of calibration slices per sample volume')
+    parser.add_argument('--min_dice', type=float, default=0.95, help='Minimum Dice score of every class against the float model to accept the int8 model')
+    args = parser.parse_args()
+    refused = quantize_main(args.model, args.view, args.image, args.eval_image, args.modality, args.size, args.n_channel, args.min_dice, args.num_slices)
+    if len(refused) > 0:
+        sys.exit(1)
@@ -0,0 +1,81 @@
+"""
+Inference-only networks loaded from exported artifacts
+
+@author: Fanwei Kong
+"""
+import numpy as np
+import tensorflow as tf
+
+class FrozenModel(object):
+    """
+    2D UNet loaded from a frozen graph written by export_model.py. It exposes
+    the parts of the Keras model interface used for prediction (predict and
+    output_shape).
+
+    Args:
+        fn: filename of the frozen graph (.pb)
+        config: optional tf.ConfigProto of the session
+    """
+    output_name = 'output'
+
+    def __init__(self, fn, config=None):
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(fn, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        inputs = [op for op in self.graph.get_operations() if op.type == 'Placeholder']
+        if len(inputs) != 1:
+            raise ValueError("Expected one input placeholder in %s, found %d" % (fn, len(inputs)))
+        self.input = inputs[0].outputs[0]
+        self.output = self.graph.get_tensor_by_name(self.output_name + ':0')
+        self.output_shape = tuple(self.output.shape.as_list())
+        self.sess = tf.Session(graph=self.graph, config=config)
+
+    def predict(self, x, batch_size=None):
+        return self.sess.run(self.output, feed_dict={self.input: x})
+
+    def close(self):
+        self.sess.close()
+
+class QuantizedModel(object):
+    """
+    2D UNet loaded from an int8 quantized TFLite model written by
+    quantize_model.py, with the same prediction interface as FrozenModel.
+
+    Args:
+        fn: filename of the TFLite model (.tflite)
+    """
+    def __init__(self, fn):
+        self.interpreter = tf.lite.Interpreter(model_path=fn)
+        self.interpreter.allocate_tensors()
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.output_shape = (None,) + tuple(self.output['shape'][1:])
+
+    def _resize(self, batch_size):
+        if self.input['shape'][0] != batch_size:
+            shape = list(self.input['shape'])
+            shape[0] = batch_size
+            self.interpreter.resize_tensor_input(self.input['index'], shape)
+            self.interpreter.allocate_tensors()
+            self.input = self.interpreter.get_input_details()[0]
+            self.output = self.interpreter.get_output_details()[0]
+
+    def predict(self, x, batch_size=None):
+        self._resize(x.shape[0])
+        if self.input['dtype'] != x.dtype:
+            # integer-only models take quantized inputs
+            scale, zero_point = self.input['quantization']
+            x = np.round(x / scale + zero_point).astype(self.input['dtype'])
+        self.interpreter.set_tensor(self.input['index'], x)
+        self.interpreter.invoke()
+        out = self.interpreter.get_tensor(self.output['index'])
+        if out.dtype != np.float32:
+            scale, zero_point = self.output['quantization']
+            out = (out.astype(np.float32) - zero_point) * scale
+        return out.copy()
+
+    def close(self):
+        self.interpreter = None
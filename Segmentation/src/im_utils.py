@@ -1,16 +1,74 @@
 import os
+import sys
 import numpy as np
 import glob
+import tempfile
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'Modeling', 'src'))
+from reorient import execute_reslice
+import parallel_gzip
 try:
     import tensorflow as tf
 except Exception as e: print(e)
 import vtk
 
-def load_vtk_image(fn):
+def _matrix_to_list(matrix):
+    if matrix is None:
+        return None
+    return [matrix.GetElement(i, j) for i in range(4) for j in range(4)]
+
+def _list_to_matrix(elements):
+    if elements is None:
+        return None
+    matrix = vtk.vtkMatrix4x4()
+    matrix.DeepCopy(list(elements))
+    return matrix
+
+def _nifti_header(reader):
+    return {'qform': _matrix_to_list(reader.GetQFormMatrix()), 'sform': _matrix_to_list(reader.GetSFormMatrix()), 'qfac': reader.GetQFac()}
+
+def read_nifti_header(fn):
+    """
+    Reads the orientation metadata of a NIfTI image without reading the voxels
+    Args:
+        fn: filename of the image data
+    Return:
+        header: dictionary of the qform and sform matrices (16 elements, row
+            major, or None) and qfac
+    """
+    reader = vtk.vtkNIFTIImageReader()
+    reader.SetFileName(fn)
+    reader.UpdateInformation()
+    return _nifti_header(reader)
+
+def nifti_load_reslice(reader):
+    """
+    Reslice of load_vtk_image that brings the output of a NIfTI reader to the
+    x/y-flipped patient orientation with isotropic spacing (the smallest one)
+    """
+    image = reader.GetOutput()
+    matrix = vtk.vtkMatrix4x4()
+    matrix.DeepCopy(reader.GetQFormMatrix() if reader.GetQFormMatrix() is not None else reader.GetSFormMatrix())
+    matrix.Invert()
+    Sign = vtk.vtkMatrix4x4()
+    Sign.Identity()
+    Sign.SetElement(0, 0, -1)
+    Sign.SetElement(1, 1, -1)
+    M = vtk.vtkMatrix4x4()
+    M.Multiply4x4(matrix, Sign, M)
+    reslice = vtk.vtkImageReslice()
+    reslice.SetInputData(image)
+    reslice.SetResliceAxes(M)
+    reslice.SetInterpolationModeToLinear()
+    reslice.SetOutputSpacing(np.min(image.GetSpacing())*np.ones(3))
+    return reslice
+
+def load_vtk_image(fn, header=None):
     """
     This function imports image file as vtk image.
     Args:
         fn: filename of the image data
+        header: optional dictionary, filled with the NIfTI orientation metadata
+            (see read_nifti_header) so that writing does not re-read the image
     Return:
         label: label map as a vtk image
     """
@@ -25,26 +83,16 @@ def load_vtk_image(fn):
         label = reader.GetOutput()
     elif ext=='nii' or ext=='nii.gz':
         reader = vtk.vtkNIFTIImageReader()
-        reader.SetFileName(fn)
-        reader.Update()
+        #block gzipped files are inflated in parallel, others read by VTK
+        with parallel_gzip.decompressed(fn) as nii_fn:
+            reader.SetFileName(nii_fn)
+            reader.Update()
         image = reader.GetOutput()
-        matrix = reader.GetQFormMatrix()
-        if matrix is None:
-            matrix = reader.GetSFormMatrix()
-        matrix.Invert()
-        Sign = vtk.vtkMatrix4x4()
-        Sign.Identity()
-        Sign.SetElement(0, 0, -1)
-        Sign.SetElement(1, 1, -1)
-        M = vtk.vtkMatrix4x4()
-        M.Multiply4x4(matrix, Sign, M)
-        reslice = vtk.vtkImageReslice()
-        reslice.SetInputData(image)
-        reslice.SetResliceAxes(M)
-        reslice.SetInterpolationModeToLinear()
-        reslice.SetOutputSpacing(np.min(image.GetSpacing())*np.ones(3))
-        reslice.Update()
-        label = reslice.GetOutput()
+        if header is not None:
+            header.update(_nifti_header(reader))
+        reslice = nifti_load_reslice(reader)
+        #numpy transpose/flip and per-axis resampling if the orientation is a permutation with flips
+        label = execute_reslice(reslice)
         py_label = vtk_to_numpy(label.GetPointData().GetScalars())
         py_label = (py_label + reader.GetRescaleIntercept())/reader.GetRescaleSlope()
         label.GetPointData().SetScalars(numpy_to_vtk(py_label))
@@ -52,6 +100,29 @@ def load_vtk_image(fn):
         raise IOError("File extension is not recognized: ", ext)
     return label
 
+def read_label_array(fn):
+    """
+    Reads a label map as it is stored in the file, without reorienting it
+    Args:
+        fn: filename of the label map (.nii, .nii.gz, .vti or .mhd)
+    Return:
+        labels: numpy array (z, y, x)
+        spacing: voxel spacing along the array axes
+    """
+    if fn.endswith('.nii') or fn.endswith('.nii.gz'):
+        reader = vtk.vtkNIFTIImageReader()
+    elif fn.endswith('.vti'):
+        reader = vtk.vtkXMLImageDataReader()
+    elif fn.endswith('.mhd'):
+        reader = vtk.vtkMetaImageReader()
+    else:
+        raise IOError("File extension is not recognized: ", fn)
+    with parallel_gzip.decompressed(fn) as in_fn:
+        reader.SetFileName(in_fn)
+        reader.Update()
+    image = reader.GetOutput()
+    return get_array_from_vtkImage(image), image.GetSpacing()[::-1]
+
 def write_vtk_image(vtkIm, fn):
     """
     This function writes a vtk image to disk
@@ -76,40 +147,112 @@ def write_vtk_image(vtkIm, fn):
     writer.Write()
     return
 
-def vtk_write_mask_as_nifty(mask, image_fn, mask_fn):
-    import vtk
-    origin = mask.GetOrigin()
-    reader = vtk.vtkNIFTIImageReader()
-    reader.SetFileName(image_fn)
-    reader.Update()
-    writer = vtk.vtkNIFTIImageWriter()
+def nifti_reslice_axes(header):
+    """
+    Reslice axes that bring an image loaded by load_vtk_image back to the
+    orientation of the NIfTI file it was read from
+    """
     Sign = vtk.vtkMatrix4x4()
     Sign.Identity()
     Sign.SetElement(0, 0, -1)
     Sign.SetElement(1, 1, -1)
-    M = reader.GetQFormMatrix()
+    M = _list_to_matrix(header['qform'])
     if M is None:
-        M = reader.GetSFormMatrix()
+        M = _list_to_matrix(header['sform'])
     M2 = vtk.vtkMatrix4x4()
     M2.Multiply4x4(Sign, M, M2)
+    return M2
+
+def reslice_mask_to_nifti(mask, header):
+    """
+    Casts a mask loaded or predicted in the orientation of load_vtk_image to
+    uint8 and reslices it back to the orientation of the NIfTI file described
+    by header
+    """
+    if mask.GetScalarType() != vtk.VTK_UNSIGNED_CHAR:
+        cast = vtk.vtkImageCast()
+        cast.SetInputData(mask)
+        cast.SetOutputScalarTypeToUnsignedChar()
+        cast.Update()
+        mask = cast.GetOutput()
     reslice = vtk.vtkImageReslice()
     reslice.SetInputData(mask)
-    reslice.SetResliceAxes(M2)
+    reslice.SetResliceAxes(nifti_reslice_axes(header))
     reslice.SetInterpolationModeToNearestNeighbor()
     reslice.Update()
-    mask = reslice.GetOutput()
+    return reslice.GetOutput()
+
+def vtk_write_mask_as_nifty(mask, image_fn, mask_fn, header=None, gzip_level=None, oriented=False):
+    """
+    This function writes a mask as a uint8 NIfTI image in the orientation of
+    the original image
+    Args:
+        mask: vtk image of the mask
+        image_fn: filename of the original image
+        mask_fn: filename of the mask
+        header: orientation metadata captured by load_vtk_image, read from
+            the header of image_fn if not given
+        gzip_level: compression level of .nii.gz masks (6 if None); they are
+            compressed in parallel blocks, or by VTK if that fails
+        oriented: the mask is a uint8 image already resliced with
+            nifti_reslice_axes, it is written as is
+    Returns:
+        None
+    """
+    import vtk
+    if not header:
+        header = read_nifti_header(image_fn)
+    if not oriented:
+        mask = reslice_mask_to_nifti(mask, header)
     mask.SetOrigin([0.,0.,0.])
+    writer = vtk.vtkNIFTIImageWriter()
 
+    compress = mask_fn.endswith('.gz')
+    if compress:
+        # next to the mask, a small tmpfs such as /dev/shm could truncate it
+        fd, out_fn = tempfile.mkstemp(suffix='.nii', dir=os.path.dirname(os.path.abspath(mask_fn)))
+        os.close(fd)
+    else:
+        out_fn = mask_fn
     writer.SetInputData(mask)
-    writer.SetFileName(mask_fn)
-    writer.SetQFac(reader.GetQFac())
-    q_mat = reader.GetQFormMatrix()
-    writer.SetQFormMatrix(q_mat)
-    s_mat = reader.GetSFormMatrix()
-    writer.SetSFormMatrix(s_mat)
+    writer.SetFileName(out_fn)
+    writer.SetQFac(header['qfac'])
+    q_mat = _list_to_matrix(header['qform'])
+    if q_mat is not None:
+        writer.SetQFormMatrix(q_mat)
+    s_mat = _list_to_matrix(header['sform'])
+    if s_mat is not None:
+        writer.SetSFormMatrix(s_mat)
     writer.Write()
+    if compress:
+        try:
+            _check_nifti_written(writer, out_fn, mask)
+            parallel_gzip.compress_file(out_fn, mask_fn, 6 if gzip_level is None else gzip_level)
+        except (IOError, OSError) as e:
+            print("Parallel gzip compression failed, using the default writer: ", e)
+            writer.SetFileName(mask_fn)
+            writer.Write()
+            _check_nifti_written(writer, mask_fn)
+        finally:
+            os.remove(out_fn)
+    else:
+        _check_nifti_written(writer, mask_fn, mask)
     return
 
+def _check_nifti_written(writer, fn, image=None):
+    """
+    Raises IOError if a vtkNIFTIImageWriter failed, which Write() does not
+    report (e.g. on a full disk). With image, the size of the uncompressed
+    file is checked as well.
+    """
+    if writer.GetErrorCode() != 0:
+        raise IOError("Failed to write %s: %s" % (fn, vtk.vtkErrorCode.GetStringFromErrorCode(writer.GetErrorCode())))
+    if image is not None:
+        # 348 byte header and 4 byte extension flag before the voxels
+        expected = 352 + int(np.prod(image.GetDimensions())) * image.GetNumberOfScalarComponents() * image.GetScalarSize()
+        if not os.path.exists(fn) or os.path.getsize(fn) < expected:
+            raise IOError("%s is truncated: %d bytes written, %d expected" % (fn, os.path.getsize(fn) if os.path.exists(fn) else 0, expected))
+
 def get_array_from_vtkImage(image):
     from vtk.util.numpy_support import vtk_to_numpy
     py_im = vtk_to_numpy(image.GetPointData().GetScalars())
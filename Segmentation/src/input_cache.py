@@ -0,0 +1,122 @@
+"""
+Content-addressed on-disk cache of preprocessed network inputs
+
+@author: Fanwei Kong
+"""
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+
+_hashes = {}
+
+def file_hash(fn, block_size=1 << 20):
+    """
+    SHA1 of the content of a file, remembered until the file is modified
+    """
+    st = os.stat(fn)
+    memo = (os.path.abspath(fn), st.st_size, st.st_mtime_ns)
+    if memo in _hashes:
+        return _hashes[memo]
+    h = hashlib.sha1()
+    with open(fn, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    _hashes[memo] = h.hexdigest()
+    return _hashes[memo]
+
+class InputCache(object):
+    """
+    Stores the normalized size^3 input volume of an image as a .npy file,
+    memory-mapped when read back, together with its image_info dictionary
+    (.json). Entries are keyed by the image content hash, the size and the
+    modality, so renamed or copied images still hit the cache.
+
+    Args:
+        cache_dir: directory of the cache
+        max_bytes: total size above which the least recently used entries are
+            removed, None for no limit
+    """
+    # bumped whenever the normalized input changes, 2: resampled with ResamplePlan in float32
+    version = 2
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except Exception as e: print(e)
+
+    def key(self, image_fn, size, modality):
+        h = hashlib.sha1()
+        h.update(('%s-%d-%s-%d' % (file_hash(image_fn), size, modality, self.version)).encode())
+        return h.hexdigest()
+
+    def _paths(self, key):
+        return os.path.join(self.cache_dir, key+'.npy'), os.path.join(self.cache_dir, key+'.json')
+
+    def load(self, key):
+        """
+        Returns:
+            (img_vol, image_info) with img_vol memory-mapped read-only, or None
+        """
+        vol_fn, info_fn = self._paths(key)
+        if not (os.path.exists(vol_fn) and os.path.exists(info_fn)):
+            return None
+        try:
+            with open(info_fn, 'r') as f:
+                info = json.load(f)
+            img_vol = np.load(vol_fn, mmap_mode='r')
+        except (IOError, OSError, ValueError) as e:
+            print("Ignoring broken cache entry %s: %s" % (key, e))
+            return None
+        # the modification time records the last access for LRU eviction
+        for fn in (vol_fn, info_fn):
+            os.utime(fn, None)
+        info = {k: tuple(v) if isinstance(v, list) else v for k, v in info.items()}
+        return img_vol, info
+
+    def store(self, key, img_vol, image_info):
+        vol_fn, info_fn = self._paths(key)
+        # write to temporary files first so that concurrent workers never read partial entries
+        for fn, write in [(vol_fn, lambda f: np.save(f, np.ascontiguousarray(img_vol))), (info_fn, lambda f: f.write(json.dumps(image_info).encode()))]:
+            fd, tmp_fn = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(tmp_fn, fn)
+        self.evict()
+
+    def entries(self):
+        """
+        Returns:
+            list of (last access time, bytes, key) of the cache entries
+        """
+        out = {}
+        for fn in os.listdir(self.cache_dir):
+            key, ext = os.path.splitext(fn)
+            if ext not in ['.npy', '.json']:
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, fn))
+            except OSError:
+                continue
+            t, b = out.get(key, (0., 0))
+            out[key] = (max(t, st.st_mtime), b + st.st_size)
+        return sorted([(t, b, k) for k, (t, b) in out.items()])
+
+    def evict(self):
+        if self.max_bytes is None:
+            return
+        entries = self.entries()
+        total = sum([b for _, b, _ in entries])
+        for _, b, key in entries:
+            if total <= self.max_bytes:
+                break
+            for fn in self._paths(key):
+                try:
+                    os.remove(fn)
+                except OSError:
+                    pass
+            total -= b
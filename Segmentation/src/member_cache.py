@@ -0,0 +1,53 @@
+"""
+On-disk cache of the probabilities of every ensemble member on every image
+
+@author: Fanwei Kong
+"""
+import hashlib
+import numpy as np
+from input_cache import InputCache, file_hash
+
+class MemberCache(InputCache):
+    """
+    Stores the [size, size, size, num_class] probabilities of one network on
+    one image, quantized to uint8 (probability * 255), so that the ensemble
+    average can be rebuilt without running the networks again. Entries are
+    keyed by the content hashes of the weight file and of the image, the view
+    and the options changing the prediction. Adding a member to the ensemble
+    then only runs the new network, and removing one only re-aggregates.
+
+    Args:
+        cache_dir: directory of the cache
+        max_bytes: total size above which the least recently used entries are
+            removed, None for no limit
+    """
+    # bumped whenever the network input changes, 2: resampled with ResamplePlan in float32
+    version = 2
+    scale = 255
+
+    def key(self, weight_fn, image_fn, view, size, modality, channel, skip_empty=False):
+        h = hashlib.sha1()
+        h.update(('%s-%s-%d-%d-%s-%d-%d-%d' % (file_hash(weight_fn), file_hash(image_fn), view, size, modality, channel, int(skip_empty), self.version)).encode())
+        return h.hexdigest()
+
+    def store(self, key, prob, info=None, chunk=16):
+        """
+        Quantizes and stores the probabilities of one member
+
+        Returns:
+            quantized: the uint8 probabilities as stored, so that the caller
+                adds the same values a later run reads back
+        """
+        quantized = np.empty(prob.shape, dtype=np.uint8)
+        for z in range(0, prob.shape[0], chunk):
+            quantized[z:z+chunk] = np.clip(np.rint(prob[z:z+chunk] * float(self.scale)), 0, self.scale)
+        super(MemberCache, self).store(key, quantized, info or {})
+        return quantized
+
+    def accumulate(self, prob, quantized, chunk=16):
+        """
+        Adds the dequantized probabilities of one member to the accumulator prob
+        """
+        for z in range(0, prob.shape[0], chunk):
+            prob[z:z+chunk] += np.multiply(quantized[z:z+chunk], 1./self.scale, dtype=prob.dtype)
+        return prob
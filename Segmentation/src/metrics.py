@@ -0,0 +1,137 @@
+"""
+Segmentation metrics computed from a single confusion matrix pass, and
+surface distances on boundary voxels
+
+@author: Fanwei Kong
+"""
+import numpy as np
+
+def confusion_matrix(pred, true, num_class=None, chunk=1 << 22):
+    """
+    Confusion matrix of two label maps in one bincount pass
+
+    Args:
+        pred: predicted label map of non-negative integer ids
+        true: ground truth label map of the same shape
+        num_class: number of ids, by default the largest id + 1
+        chunk: number of voxels counted at once, bounds the temporary index array
+    Returns:
+        cm: [num_class, num_class] int64 array, cm[t, p] is the number of
+            voxels labelled t in true and p in pred
+    """
+    pred, true = np.asarray(pred).reshape(-1), np.asarray(true).reshape(-1)
+    if pred.size != true.size:
+        raise ValueError("Label maps of different sizes: %d and %d voxels" % (pred.size, true.size))
+    if pred.size == 0:
+        return np.zeros((num_class or 0, num_class or 0), dtype=np.int64)
+    if min(pred.min(), true.min()) < 0:
+        raise ValueError("Label ids should be non-negative")
+    max_id = int(max(pred.max(), true.max()))
+    if num_class is None:
+        num_class = max_id + 1
+    elif max_id >= num_class:
+        raise ValueError("Label id %d is out of range for %d classes" % (max_id, num_class))
+    cm = np.zeros(num_class*num_class, dtype=np.int64)
+    for i in range(0, pred.size, chunk):
+        idx = true[i:i+chunk].astype(np.intp) * num_class
+        np.add(idx, pred[i:i+chunk], out=idx, casting='unsafe')
+        cm += np.bincount(idx, minlength=num_class*num_class)
+    return cm.reshape(num_class, num_class)
+
+def dice_from_confusion(cm):
+    """
+    Dice score of every class, nan for classes absent from both label maps
+    """
+    tp = np.diag(cm).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return 2.*tp / (cm.sum(axis=0) + cm.sum(axis=1))
+
+def iou_from_confusion(cm):
+    """
+    Intersection over union of every class, nan for classes absent from both
+    label maps
+    """
+    tp = np.diag(cm).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return tp / (cm.sum(axis=0) + cm.sum(axis=1) - tp)
+
+def foreground_dice(cm, bg_id=0):
+    """
+    Dice score of the voxels with the same non-background label in both maps
+    """
+    keep = np.arange(len(cm)) != bg_id
+    agree = np.diag(cm)[keep].sum()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return 2.*agree / (cm[:, keep].sum() + cm[keep, :].sum())
+
+def boundary_voxels(mask):
+    """
+    Voxels of a binary mask with at least one face neighbour outside the mask
+    (or on the volume border)
+    """
+    mask = np.asarray(mask, dtype=bool)
+    interior = mask.copy()
+    for axis in range(mask.ndim):
+        front = [slice(None)]*mask.ndim
+        back = [slice(None)]*mask.ndim
+        front[axis], back[axis] = slice(1, None), slice(None, -1)
+        interior[tuple(back)] &= mask[tuple(front)]
+        interior[tuple(front)] &= mask[tuple(back)]
+        border = [slice(None)]*mask.ndim
+        for end in [0, -1]:
+            border[axis] = end
+            interior[tuple(border)] = False
+    return mask & ~interior
+
+def surface_distances(pred_mask, true_mask, spacing=(1., 1., 1.)):
+    """
+    Distances from the boundary voxels of each mask to the nearest boundary
+    voxel of the other, using a KD-tree
+
+    Returns:
+        d_pred: distances of the predicted boundary voxels, None if a mask is empty
+        d_true: distances of the true boundary voxels
+    """
+    from scipy.spatial import cKDTree
+    pts = [np.argwhere(boundary_voxels(m)) * np.asarray(spacing) for m in (pred_mask, true_mask)]
+    if len(pts[0]) == 0 or len(pts[1]) == 0:
+        return None, None
+    d_pred, _ = cKDTree(pts[1]).query(pts[0])
+    d_true, _ = cKDTree(pts[0]).query(pts[1])
+    return d_pred, d_true
+
+def hd95_assd(pred_mask, true_mask, spacing=(1., 1., 1.)):
+    """
+    95th percentile Hausdorff distance of both directed distance sets pooled
+    together, and average symmetric surface distance (mean of the two
+    directed mean distances), nan if a mask is empty
+    """
+    d_pred, d_true = surface_distances(pred_mask, true_mask, spacing)
+    if d_pred is None:
+        return np.nan, np.nan
+    return np.percentile(np.hstack((d_pred, d_true)), 95), (d_pred.mean() + d_true.mean())/2.
+
+def evaluate(pred, true, spacing=(1., 1., 1.), surface=True, bg_id=0):
+    """
+    Metrics of every label of true except the background
+
+    Args:
+        pred: predicted label map
+        true: ground truth label map
+        spacing: voxel spacing along the array axes
+        surface: compute the surface distances (HD95 and ASSD)
+    Returns:
+        scores: dictionary of class id to a dictionary of dice, iou and, with
+            surface, hd95 and assd; the 'foreground' entry holds the Dice
+            score over all non-background labels
+    """
+    cm = confusion_matrix(pred, true)
+    dice, iou = dice_from_confusion(cm), iou_from_confusion(cm)
+    scores = {'foreground': {'dice': foreground_dice(cm, bg_id)}}
+    for c in np.nonzero(cm.sum(axis=1))[0]:
+        if c == bg_id:
+            continue
+        scores[int(c)] = {'dice': dice[c], 'iou': iou[c]}
+        if surface:
+            scores[int(c)]['hd95'], scores[int(c)]['assd'] = hd95_assd(pred == c, true == c, spacing)
+    return scores
@@ -0,0 +1,68 @@
+"""
+In-memory pool of the 2D UNet ensemble members
+
+@author: Fanwei Kong
+"""
+from collections import OrderedDict
+from tensorflow.python.keras import models as models_keras
+from model import UNet2D
+from frozen_model import FrozenModel, QuantizedModel
+
+class ModelPool(object):
+    """
+    Keeps one UNet2D per weight file so that each weight file is read only once
+    per process and reused for every image. Keras weights (.hdf5) are loaded
+    into a UNet2D, frozen graphs (.pb) into a FrozenModel and int8 TFLite
+    models (.tflite) into a QuantizedModel.
+
+    Args:
+        img_shape: input shape of the networks (size, size, channel)
+        num_class: number of output classes
+        max_models: maximum number of networks kept in memory, None for no limit.
+            When the limit is reached, the least recently used network is
+            reloaded with the requested weights instead of building a new one.
+        session_config: optional tf.ConfigProto for the sessions of frozen graphs
+    """
+    def __init__(self, img_shape, num_class, max_models=None, session_config=None):
+        if max_models is not None and max_models < 1:
+            raise ValueError("At least one model should be kept in memory")
+        self.img_shape = img_shape
+        self.num_class = num_class
+        self.max_models = max_models
+        self.session_config = session_config
+        self.models = OrderedDict()
+        self.num_loads = 0
+
+    def build(self):
+        inputs, outputs = UNet2D(self.img_shape, self.num_class)
+        return models_keras.Model(inputs=[inputs], outputs=[outputs])
+
+    def load(self, model, weight_fn):
+        model.load_weights(weight_fn)
+        return model
+
+    def get(self, weight_fn):
+        """
+        Returns the network with the weights of weight_fn loaded
+        """
+        if weight_fn in self.models:
+            self.models.move_to_end(weight_fn)
+            return self.models[weight_fn]
+        evicted = None
+        if self.max_models is not None and len(self.models) >= self.max_models:
+            _, evicted = self.models.popitem(last=False)
+            if isinstance(evicted, (FrozenModel, QuantizedModel)):
+                evicted.close()
+                evicted = None
+        if weight_fn.endswith('.pb'):
+            model = FrozenModel(weight_fn, self.session_config)
+        elif weight_fn.endswith('.tflite'):
+            model = QuantizedModel(weight_fn)
+        else:
+            model = self.load(evicted if evicted is not None else self.build(), weight_fn)
+        self.num_loads += 1
+        self.models[weight_fn] = model
+        return model
+
+    def __len__(self):
+        return len(self.models)
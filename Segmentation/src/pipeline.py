@@ -0,0 +1,109 @@
+"""
+Pipelined execution of the load / inference / write stages of the segmentation
+
+@author: Fanwei Kong
+"""
+import threading
+import time
+import traceback
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+_DONE = object()
+
+class Pipeline(object):
+    """
+    Runs load_fn, infer_fn and write_fn over a list of items. Loading (and
+    preprocessing) and writing run on background threads connected to the
+    inference stage by bounded queues, so item k+1 is loaded and item k-1 is
+    written while item k is in inference. Inference runs on the calling thread.
+
+    A failing item is reported in the results and does not stop the others.
+
+    Args:
+        load_fn: function(item) returning the loaded value
+        infer_fn: function(item, loaded) returning the prediction
+        write_fn: function(item, prediction)
+        depth: maximum number of items waiting between two stages
+    """
+    def __init__(self, load_fn, infer_fn, write_fn, depth=1):
+        self.load_fn = load_fn
+        self.infer_fn = infer_fn
+        self.write_fn = write_fn
+        self.depth = depth
+        self.stats = {}
+
+    def _reset_stats(self):
+        # busy: time spent in the stage function, stall: time waiting on the queues
+        self.stats = {s: {'busy': 0., 'stall': 0.} for s in ['load', 'infer', 'write']}
+
+    def _run_stage(self, name, fn, *args):
+        start = time.time()
+        try:
+            out, err = fn(*args), None
+        except Exception:
+            out, err = None, traceback.format_exc()
+        self.stats[name]['busy'] += time.time() - start
+        return out, err
+
+    def _get(self, name, q):
+        start = time.time()
+        value = q.get()
+        self.stats[name]['stall'] += time.time() - start
+        return value
+
+    def _put(self, name, q, value):
+        start = time.time()
+        q.put(value)
+        self.stats[name]['stall'] += time.time() - start
+
+    def _loader(self, items, load_q):
+        for i, item in enumerate(items):
+            start = time.time()
+            out, err = self._run_stage('load', self.load_fn, item)
+            self._put('load', load_q, (i, out, err, start))
+        self._put('load', load_q, _DONE)
+
+    def _writer(self, items, write_q, results):
+        while True:
+            value = self._get('write', write_q)
+            if value is _DONE:
+                break
+            i, out, err, start = value
+            if err is None:
+                _, err = self._run_stage('write', self.write_fn, items[i], out)
+            results[i] = (items[i], err, time.time()-start)
+
+    def run(self, items):
+        """
+        Returns:
+            results: list of (item, error traceback or None, seconds) in input order
+        """
+        self._reset_stats()
+        items = list(items)
+        results = [None] * len(items)
+        load_q = queue.Queue(self.depth)
+        write_q = queue.Queue(self.depth)
+        loader = threading.Thread(target=self._loader, args=(items, load_q))
+        writer = threading.Thread(target=self._writer, args=(items, write_q, results))
+        loader.daemon = writer.daemon = True
+        loader.start()
+        writer.start()
+        while True:
+            value = self._get('infer', load_q)
+            if value is _DONE:
+                break
+            i, out, err, start = value
+            if err is None:
+                out, err = self._run_stage('infer', self.infer_fn, items[i], out)
+            self._put('infer', write_q, (i, out, err, start))
+        self._put('infer', write_q, _DONE)
+        loader.join()
+        writer.join()
+        return results
+
+    def report(self):
+        for name in ['load', 'infer', 'write']:
+            print("Pipeline %s stage: busy %.1f s, stalled %.1f s" % (name, self.stats[name]['busy'], self.stats[name]['stall']))
@@ -1,48 +1,108 @@
+import os
+import sys
 import numpy as np
 import vtk
+import threading
+from collections import OrderedDict
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'Modeling', 'src'))
+from label_remap import remap_labels, present_labels
+from label_volume import LabelVolume
 
 def swap_labels(labels):
-    unique_label = np.unique(labels)
-
-    new_label = range(len(unique_label))
-    for i in range(len(unique_label)):
-        label = unique_label[i]
-        newl = new_label[i]
-        labels[labels==label] = newl
-    return labels
+    unique_label = present_labels(labels)
+    return remap_labels(labels, unique_label, np.arange(len(unique_label)), default=0)
   
 def swap_labels_back(labels,pred):
-    unique_label = np.unique(labels)
-    new_label = range(len(unique_label))
-
-    for i in range(len(unique_label)):
-      pred[pred==i] = unique_label[i]
-      
-    return pred
+    unique_label = present_labels(labels)
+    return remap_labels(pred, np.arange(len(unique_label)), unique_label)
     
 
+def histogram_percentiles(im, percentiles, bins=65536):
+    """
+    Computes percentiles (linear interpolation, as np.percentile) from a single
+    histogram pass instead of sorting the volume.
+
+    Integer images are binned per intensity level, which is exact. Other images
+    use `bins` uniform bins between the minimum and maximum, so the error is
+    bounded by one bin width, (max-min)/bins.
+
+    Args:
+        im: numpy array
+        percentiles: list of percentiles in [0, 100]
+        bins: number of bins for non-integer images
+    Returns:
+        values: list of the percentile values
+    """
+    lo, hi = float(np.min(im)), float(np.max(im))
+    if hi == lo:
+        return [lo for _ in percentiles]
+    if np.issubdtype(im.dtype, np.integer) and hi - lo < 1 << 24:
+        counts = np.bincount((im.ravel() - int(lo)).astype(np.intp, copy=False), minlength=int(hi-lo)+1)
+        edges = lo + np.arange(len(counts), dtype=np.float64)
+        width = 0.
+    else:
+        counts, edges = np.histogram(im, bins=bins, range=(lo, hi))
+        width = edges[1] - edges[0]
+    cum = np.cumsum(counts)
+    n = cum[-1]
+    def order_statistic(k):
+        #value of the k-th smallest element (0-based), interpolated within its bin
+        b = np.searchsorted(cum, k, side='right')
+        before = cum[b-1] if b > 0 else 0
+        return edges[b] + width * (k - before + 0.5) / counts[b]
+    values = []
+    for q in percentiles:
+        rank = q / 100. * (n - 1)
+        k = int(np.floor(rank))
+        v = order_statistic(k)
+        if rank > k:
+            v += (rank - k) * (order_statistic(k+1) - v)
+        values.append(min(max(v, lo), hi))
+    return values
+
+def _clip_scale(im, lower, upper, scale, offset, chunk=1 << 18):
+    """
+    In place im = clip(im, lower, upper) * scale + offset, processed in chunks
+    that stay in cache so the volume is traversed once
+    """
+    flat = im.reshape(-1)
+    for i in range(0, flat.size, chunk):
+        c = flat[i:i+chunk]
+        np.clip(c, lower, upper, out=c)
+        c *= scale
+        c += offset
+    return im
+
 def rescale_intensity(slice_im,m,limit):
+    """
+    Normalizes the image intensity to [-1, 1].
+
+    The image is converted to float32 (in place if it already is) and clipped
+    and scaled in a single pass. CT images are clipped to limit, MR images to
+    their 20th and 99th percentiles, computed on the input before the float32
+    conversion so that integer images get exact percentiles.
+
+    Args:
+        slice_im: numpy array
+        m: modality, ct or mr
+        limit: [upper, lower] intensity window of ct images
+    Returns:
+        slice_im: normalized float32 array
+    """
     if type(slice_im) != np.ndarray:
         raise RuntimeError("Input image is not numpy array")
-    #slice_im: numpy array
-    #m: modality, ct or mr
+    if m not in ["ct", "mr"]:
+        return slice_im
     if m =="ct":
-        rng = abs(limit[0]-limit[1])
-        threshold = rng/2
-        slice_im[slice_im>limit[0]] = limit[0]
-        slice_im[slice_im<limit[1]] = limit[1]
-        slice_im = slice_im/threshold
+        lower, upper = limit[1], limit[0]
+        scale = 2./abs(limit[0]-limit[1])
+        offset = 0.
     elif m=="mr":
-        pls = np.unique(slice_im)
-        upper = np.percentile(slice_im, 99)
-        lower = np.percentile(slice_im, 20)
-        slice_im[slice_im>upper] = upper
-        slice_im[slice_im<lower] = lower
-        slice_im -= int(lower)
-        rng = upper - lower
-        slice_im = slice_im/rng*2
-        slice_im -= 1
-    return slice_im
+        lower, upper = histogram_percentiles(slice_im, [20, 99])
+        scale = 2./(upper - lower)
+        offset = -int(lower)*scale - 1.
+    slice_im = np.ascontiguousarray(slice_im, dtype=np.float32)
+    return _clip_scale(slice_im, lower, upper, scale, offset)
 
 def vtk_resample_to_size(image, new_size, order=1):
     size = image.GetDimensions()
@@ -90,5 +150,230 @@ def vtk_resample_with_info_dict(image, img_info, order=1):
     im.SetOrigin(img_info['origin'])
     return im
 
+def _reslice_geometry(extent, spacing, origin, axes=None, out_extent=None, out_spacing=None):
+    """
+    Output extent, spacing and origin that vtkImageReslice picks for an input
+    geometry, from the pipeline information only (no voxels are resliced)
+    """
+    image = vtk.vtkImageData()
+    image.SetExtent(*[int(e) for e in extent])
+    image.SetSpacing(spacing)
+    image.SetOrigin(origin)
+    reslice = vtk.vtkImageReslice()
+    reslice.SetInputData(image)
+    if axes is not None:
+        reslice.SetResliceAxes(axes)
+    if out_extent is not None:
+        reslice.SetOutputExtent(*[int(e) for e in out_extent])
+    if out_spacing is not None:
+        reslice.SetOutputSpacing(out_spacing)
+    reslice.UpdateInformation()
+    info = reslice.GetOutputInformation(0)
+    return (np.array(info.Get(vtk.vtkStreamingDemandDrivenPipeline.WHOLE_EXTENT())),
+            np.array(info.Get(vtk.vtkDataObject.SPACING())), np.array(info.Get(vtk.vtkDataObject.ORIGIN())))
+
+def _nearest_index(x, lo, hi):
+    """
+    Nearest voxel index of continuous indices x and whether it lies in the
+    extent [lo, hi], i.e. within the half voxel border vtkImageReslice uses
+    """
+    idx = np.floor(x + 0.5).astype(np.int64)
+    return idx, (idx >= lo) & (idx <= hi)
+
+class ResamplePlan(object):
+    """
+    Resampling between two axis-aligned grids (vtkImageReslice without reslice
+    axes), precomputed once per source and target geometry. For every axis it
+    stores the source indices and weights vtkImageReslice would use, with the
+    same half voxel border and a background of 0, and applies them with
+    vectorized numpy gathers along one axis at a time (trilinear interpolation
+    is separable).
+
+    Args:
+        in_extent, in_spacing, in_origin: source grid
+        out_extent, out_spacing, out_origin: target grid
+        order: 1 for trilinear, 0 for nearest neighbour interpolation
+    """
+    def __init__(self, in_extent, in_spacing, in_origin, out_extent, out_spacing, out_origin, order=1):
+        if order not in [0, 1]:
+            raise ValueError("interpolation option not recognized")
+        self.order = order
+        self.in_shape = tuple(int(in_extent[2*c+1]-in_extent[2*c]+1) for c in range(3))[::-1]
+        self.shape = tuple(int(out_extent[2*c+1]-out_extent[2*c]+1) for c in range(3))[::-1]
+        # per VTK axis (x, y, z): index relative to the source extent and weights
+        self.axes = []
+        for c in range(3):
+            lo, hi = in_extent[2*c], in_extent[2*c+1]
+            t = np.arange(out_extent[2*c], out_extent[2*c+1]+1)
+            u = (out_origin[c] + t*out_spacing[c] - in_origin[c])/in_spacing[c]
+            if order == 0:
+                idx, valid = _nearest_index(u, lo, hi)
+                self.axes.append((np.where(valid, idx-lo, 0), valid))
+            else:
+                valid = (u >= lo-0.5) & (u <= hi+0.5)
+                f = np.floor(u)
+                w = np.where(valid, u-f, 0.)
+                i0 = np.clip(f, lo, hi).astype(np.int64) - lo
+                i1 = np.clip(f+1, lo, hi).astype(np.int64) - lo
+                self.axes.append((i0, i1, np.where(valid, 1.-w, 0.), w))
+
+    def lut(self, c):
+        """
+        Nearest source index along VTK axis c of every target index, -1 outside
+        """
+        idx, valid = self.axes[c]
+        return np.where(valid, idx, -1)
+
+    def apply(self, vol, dtype=np.float32):
+        """
+        Resamples a (z, y, x) numpy volume of the source grid to the target grid
+        """
+        vol = np.asarray(vol)
+        if vol.shape != self.in_shape:
+            raise ValueError("Volume of shape %s does not match the plan source shape %s" % (vol.shape, self.in_shape))
+        if self.order == 0:
+            (ix, vx), (iy, vy), (iz, vz) = self.axes
+            out = vol[np.ix_(iz, iy, ix)].astype(dtype, copy=False)
+            out[~(vz[:, np.newaxis, np.newaxis] & vy[np.newaxis, :, np.newaxis] & vx[np.newaxis, np.newaxis, :])] = 0
+            return out
+        out = vol
+        for c in range(3):
+            axis = 2 - c
+            i0, i1, w0, w1 = self.axes[c]
+            shape = [1, 1, 1]
+            shape[axis] = -1
+            a = np.take(out, i0, axis=axis).astype(dtype, copy=False)
+            a *= w0.astype(dtype).reshape(shape)
+            a += np.take(out, i1, axis=axis) * w1.astype(dtype).reshape(shape)
+            out = a
+        return out
+
+_plans = OrderedDict()
+# the loader and writer threads of --pipeline build plans concurrently
+_plans_lock = threading.Lock()
+
+def _cached_plan(key, make, max_plans=64):
+    with _plans_lock:
+        plan = _plans.get(key)
+        if plan is not None:
+            _plans.move_to_end(key)
+            return plan
+    # built outside the lock, a plan racing with another thread is built twice
+    plan = make()
+    with _plans_lock:
+        _plans[key] = plan
+        _plans.move_to_end(key)
+        while len(_plans) > max_plans:
+            _plans.popitem(last=False)
+    return plan
+
+def _geometry_key(*arrays):
+    return tuple(tuple(np.round(np.asarray(a, dtype=np.float64), 9).tolist()) for a in arrays)
+
+def size_plan(extent, spacing, origin, new_size, order=1):
+    """
+    Plan of vtk_resample_to_size for an image geometry, cached by geometry
+    """
+    def make():
+        size = np.array([extent[2*c+1]-extent[2*c]+1 for c in range(3)])
+        reference_spacing = np.mean(size/np.array(new_size)*np.array(spacing))*np.ones(3)
+        out_extent = (0, new_size[0]-1, 0, new_size[1]-1, 0, new_size[2]-1)
+        out_extent, out_spacing, out_origin = _reslice_geometry(extent, spacing, origin, out_extent=out_extent, out_spacing=reference_spacing)
+        return ResamplePlan(extent, spacing, origin, out_extent, out_spacing, out_origin, order)
+    return _cached_plan(('size',) + _geometry_key(extent, spacing, origin, new_size) + (order,), make)
+
+def native_plan(size, img_info, order=0):
+    """
+    Plan of vtk_resample_with_info_dict from a size[0] x size[1] x size[2]
+    reference grid back to the native grid of img_info, cached by geometry
+    """
+    def make():
+        reference_spacing = np.array(img_info['size'])/np.array(size)*np.array(img_info['spacing'])
+        reference_spacing = np.mean(reference_spacing)*np.ones(3)
+        in_extent = (0, size[0]-1, 0, size[1]-1, 0, size[2]-1)
+        out_extent, out_spacing, out_origin = _reslice_geometry(in_extent, reference_spacing, (0., 0., 0.), out_extent=img_info['extent'], out_spacing=img_info['spacing'])
+        return ResamplePlan(in_extent, reference_spacing, (0., 0., 0.), out_extent, out_spacing, out_origin, order)
+    return _cached_plan(('native',) + _geometry_key(size, img_info['size'], img_info['spacing'], img_info['extent']) + (order,), make)
+
+def resample_to_size(image, new_size, order=1):
+    """
+    vtk_resample_to_size with a cached ResamplePlan, returns the (z, y, x)
+    float32 numpy volume
+    """
+    if order == 3:
+        return LabelVolume(vtk_resample_to_size(image, new_size, order)).buffer.astype(np.float32)
+    plan = size_plan(image.GetExtent(), image.GetSpacing(), image.GetOrigin(), new_size, order)
+    return plan.apply(LabelVolume(image).buffer)
+
+def resample_with_info_dict(py_im, img_info, order=0):
+    """
+    vtk_resample_with_info_dict for a (z, y, x) numpy volume with a cached
+    ResamplePlan, returns a vtk image on the native grid
+    """
+    plan = native_plan(py_im.shape[::-1], img_info, order)
+    image = vtk.vtkImageData()
+    image.SetExtent(*[int(e) for e in img_info['extent']])
+    image.SetSpacing(img_info['spacing'])
+    image.SetOrigin(img_info['origin'])
+    LabelVolume(image).set_scalars(plan.apply(py_im, py_im.dtype))
+    return image
+
+def resample_labels_streamed(labels, img_info, axes=None, slab=16):
+    """
+    Nearest neighbour resampling of a label map predicted on the reference
+    grid back to the native grid, as vtk_resample_with_info_dict(order=0)
+    does, optionally followed by the reslice with axes applied when writing
+    NIfTI files. Both index mappings are composed and the output is filled
+    slab by slab along z, so only the uint8 output buffer is allocated at
+    full native size.
+
+    Args:
+        labels: numpy label map (z, y, x) on the reference grid
+        img_info: dictionary of the native spacing, origin, extent and size
+        axes: vtkMatrix4x4 of the second reslice, None for the native grid
+        slab: number of output z slices mapped at once
+    Returns:
+        image: uint8 vtk image
+    """
+    labels = np.asarray(labels)
+    size = labels.shape[::-1]
+    nat_extent = np.array(img_info['extent'])
+    nat_spacing = np.array(img_info['spacing'])
+    # native index -> reference index along every axis, -1 outside
+    plan = native_plan(size, img_info, order=0)
+    luts = [plan.lut(c) for c in range(3)]
+
+    # output index t -> continuous native index A t + b
+    if axes is None:
+        out_extent, out_spacing, out_origin = nat_extent, nat_spacing, np.array(img_info['origin'])
+        A, b = np.eye(3), np.zeros(3)
+    else:
+        out_extent, out_spacing, out_origin = _reslice_geometry(nat_extent, nat_spacing, img_info['origin'], axes=axes)
+        M = np.array([[axes.GetElement(i, j) for j in range(4)] for i in range(4)])
+        A = M[:3, :3]*out_spacing[np.newaxis, :]/nat_spacing[:, np.newaxis]
+        b = (M[:3, :3].dot(out_origin) + M[:3, 3] - np.array(img_info['origin']))/nat_spacing
 
+    t = [np.arange(out_extent[2*a], out_extent[2*a+1]+1) for a in range(3)]
+    out = np.zeros((len(t[2]), len(t[1]), len(t[0])), dtype=np.uint8)
+    for k in range(0, out.shape[0], slab):
+        grid = [t[0][np.newaxis, np.newaxis, :], t[1][np.newaxis, :, np.newaxis], t[2][k:k+slab, np.newaxis, np.newaxis]]
+        valid = True
+        ref = []
+        for c in range(3):
+            # only the output axes the native axis depends on are broadcast
+            q = np.full((1, 1, 1), b[c])
+            for a in range(3):
+                if abs(A[c, a]) > 1e-12:
+                    q = q + A[c, a]*grid[a]
+            q, inside = _nearest_index(q, nat_extent[2*c], nat_extent[2*c+1])
+            r = luts[c][np.where(inside, q - nat_extent[2*c], 0)]
+            valid = valid & inside & (r >= 0)
+            ref.append(np.maximum(r, 0))
+        out[k:k+slab] = np.where(valid, labels[ref[2], ref[1], ref[0]], 0)
 
+    image = vtk.vtkImageData()
+    image.SetExtent(*[int(e) for e in out_extent])
+    image.SetSpacing(*out_spacing)
+    image.SetOrigin(*out_origin)
+    LabelVolume(image).set_scalars(out)
+    return image
@@ -0,0 +1,100 @@
+"""
+Memory-mapped storage of the averaged per-class probability maps
+
+@author: Fanwei Kong
+"""
+import os
+import json
+import tempfile
+import numpy as np
+
+def probability_filenames(out_fn):
+    """
+    Probability map (.npy) and metadata (.json) filenames of a segmentation
+    """
+    for ext in ['.nii.gz', '.nii', '.vti', '.mhd']:
+        if out_fn.endswith(ext):
+            out_fn = out_fn[:-len(ext)]
+            break
+    return out_fn+'_prob.npy', out_fn+'_prob.json'
+
+class ProbabilityWriter(object):
+    """
+    Stores the ensemble average probabilities of an image as a uint8 .npy
+    file of shape [num_class, z, y, x] (probability * 255, class-major so that
+    one class or one z slab is contiguous on disk) and a .json file with the
+    image geometry and the views included so far. update() rewrites the file
+    in place from the running sum, so it can be called after every view.
+
+    Args:
+        fn: output .npy filename, the metadata goes to the matching .json
+        shape: (z, y, x) shape of the network input volume
+        num_class: number of classes
+        image_info: geometry of the native image (spacing, origin, extent,
+            size), as collected by Prediction.prepare_input_vtk
+        chunk: number of z slices converted at once
+    """
+    scale = 255
+
+    def __init__(self, fn, shape, num_class, image_info=None, chunk=16):
+        self.fn = fn
+        self.info_fn = os.path.splitext(fn)[0]+'.json'
+        self.chunk = chunk
+        out_dir = os.path.dirname(os.path.abspath(fn))
+        if not os.path.isdir(out_dir):
+            try:
+                os.makedirs(out_dir)
+            except Exception as e: print(e)
+        self.array = np.lib.format.open_memmap(fn, mode='w+', dtype=np.uint8, shape=(num_class,)+tuple(shape))
+        self.info = {'shape': list(shape), 'num_class': num_class, 'scale': self.scale, 'axes': 'czyx', 'views': []}
+        self.info.update({k: v for k, v in (image_info or {}).items() if k in ['spacing', 'origin', 'extent', 'size', 'nifti']})
+
+    def update(self, prob, count, views):
+        """
+        Writes the quantized average of the running probability sum
+
+        Args:
+            prob: [z, y, x, num_class] sum of the probabilities so far
+            count: number of predictions summed per voxel, scalar or [z, y, x]
+            views: views included in prob
+        """
+        for z in range(0, prob.shape[0], self.chunk):
+            n = count if np.isscalar(count) else count[z:z+self.chunk, ..., np.newaxis]
+            p = prob[z:z+self.chunk].astype(np.float32) * (float(self.scale) / n)
+            self.array[:, z:z+self.chunk] = np.moveaxis(np.clip(np.rint(p), 0, self.scale).astype(np.uint8), -1, 0)
+        self.array.flush()
+        self.info['views'] = [int(v) for v in views]
+        # replace the metadata atomically so that readers never see a partial file
+        fd, tmp_fn = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.info_fn)), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.info, f)
+        os.replace(tmp_fn, self.info_fn)
+
+    def close(self):
+        self.array.flush()
+        del self.array
+
+def read_probability_info(fn):
+    with open(os.path.splitext(fn)[0]+'.json', 'r') as f:
+        return json.load(f)
+
+def read_probability(fn, class_id=None, slab=None, as_float=True):
+    """
+    Reads a probability map written by ProbabilityWriter, only the requested
+    part is read from disk
+
+    Args:
+        fn: .npy filename
+        class_id: class to read, all classes if None
+        slab: (start, stop) z range to read, all slices if None
+        as_float: convert to float32 probabilities in [0, 1], otherwise the
+            quantized uint8 values are returned
+    Returns:
+        prob: [z, y, x] if class_id is given, [num_class, z, y, x] otherwise
+    """
+    array = np.load(fn, mmap_mode='r')
+    z = slice(None) if slab is None else slice(*slab)
+    out = array[class_id, z] if class_id is not None else array[:, z]
+    if as_float:
+        return out.astype(np.float32) / ProbabilityWriter.scale
+    return np.array(out)